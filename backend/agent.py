@@ -1,99 +1,287 @@
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
-from sentence_transformers import SentenceTransformer
-from ddgs import DDGS
 from history import HistoryManager
-import gc
+from query_builder import QueryBuilder
+from search_cache import SearchCache
+from search import SEARCH_DEADLINE_S, SearchFanout, merge_results, search_time_left
+from reranker import SnippetReranker
+from memory_index import SemanticIndex
+from prompt_builder import PromptBuilder, PromptSection, split_sources
+from metrics import PipelineMetrics, RequestTrace, current_trace, stage
 import time
-
-MODEL_ID = "NicolasRodriguez/manaba_gemma_2_2b" 
+import threading
+from contextlib import contextmanager
+
+# torch, transformers, sentence_transformers y ddgs se importan al usarse por primera vez
+# (engine.py, get_embedder, _safe_ddg_search): el servidor arranca sin esperar por ellos.
+EMBEDDER_ID = 'all-MiniLM-L6-v2'
+# Precargar MiniLM en paralelo con el LLM durante el arranque (si no, se carga al primer uso)
+PRELOAD_EMBEDDER = True
+# Descarga del modelo por inactividad (0 = nunca); se recarga solo en la siguiente petición
+IDLE_UNLOAD_MINUTES = 30
+# Si la GPU queda con menos de PRESSURE_FREE_FRACTION libre y otros programas ocupan al menos
+# PRESSURE_OTHERS_FRACTION (sin contar lo que reservó Titi), se descarga antes
+PRESSURE_UNLOAD_MINUTES = 5
+PRESSURE_FREE_FRACTION = 0.10
+PRESSURE_OTHERS_FRACTION = 0.10
+IDLE_CHECK_INTERVAL_S = 30
 MAX_DOCS = 12
 MAX_HISTORY_TURNS = 6
+ANSWER_MAX_TOKENS = 2000
+# Pisos del presupuesto de tokens del prompt (ver prompt_builder.py)
+SELECTION_MIN_TOKENS = 512
+EVIDENCE_MIN_TOKENS = 512
+
+# Resumen incremental del historial: los turnos viejos se resumen en segundo plano y
+# el prompt usa el resumen + los mensajes posteriores literales. Se resume por bloques,
+# solo cuando lo no resumido pasa de SUMMARY_TRIGGER_TOKENS (o de MAX_HISTORY_TURNS
+# mensajes): entre bloques el prefijo del prompt no cambia y el KV cache de la sesión sirve.
+ENABLE_HISTORY_SUMMARY = True
+SUMMARY_KEEP_MESSAGES = 2
+SUMMARY_TRIGGER_TOKENS = 1500
+# El resumen cede el modelo a las peticiones del usuario: espera a que no haya ninguna
+# en curso y se interrumpe si llega una (se reintenta hasta SUMMARY_MAX_WAIT_S)
+SUMMARY_IDLE_POLL_S = 0.5
+SUMMARY_MAX_WAIT_S = 300
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_TURN_MAX_TOKENS = 600
+SUMMARY_PROMPT = """<start_of_turn>user
+Eres el módulo de memoria de Titi, un asistente de investigación. Actualiza el resumen de la conversación
+incorporando los turnos nuevos. Conserva: el tema de investigación, las preguntas del usuario, las
+conclusiones de Titi, las fuentes o normas citadas y cualquier preferencia expresada.
+Escribe en español, en prosa breve, máximo 200 palabras. No inventes nada.
 
-class LLMEngine:
-    """
-    Clase para manejar el modelo de lenguaje LLM.
-    Carga el modelo y el tokenizador, y proporciona un método para generar texto.
-    """
-    def __init__(self):
-        """
-         Inicializa el modelo y el tokenizador.
-        """
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f":) Titi Cargando en {self.device}...")
-        self.embedder = SentenceTransformer('all-MiniLM-L6-v2', device='cpu')
+"""
+# Construcción de la query de búsqueda: 'keywords' (sin modelo), 'embedding' (MiniLM) o 'llm'
+QUERY_BUILDER_MODE = "keywords"
+# Cache persistente de resultados de DuckDuckGo
+SEARCH_CACHE_TTL_HOURS = 24
+SEARCH_CACHE_MAX_ENTRIES = 5000
+
+# Índice semántico local de evidencia previa; también cubre el modo sin conexión
+LOCAL_INDEX_K = 6
+LOCAL_INDEX_MIN_SCORE = 0.45
+# Con LOCAL_INDEX_SKIP_WEB_HITS aciertos por encima de este puntaje no se consulta la red
+LOCAL_INDEX_SKIP_WEB_SCORE = 0.75
+LOCAL_INDEX_SKIP_WEB_HITS = 4
+
+ACADEMIC_FILTERS = 'filetype:pdf -site:academia.edu -site:researchgate.net (site:edu.co OR site:sciencedirect.com OR site:arxiv.org OR site:scielo.org OR site:redalyc.org OR site:dialnet.unirioja.es)'
+ACADEMIC_FALLBACK_FILTERS = "research paper filetype:pdf -site:academia.edu -site:researchgate.net"
+LEGAL_SITES = [
+    "suin-juriscol.gov.co",
+    "corteconstitucional.gov.co",
+    "cortesuprema.gov.co",
+    "consejodeestado.gov.co",
+    "funcionpublica.gov.co",
+]
+
+# Prefijos fijos de los prompts finales. Van primero para que su KV-cache se
+# calcule una sola vez al cargar el modelo (ver LLMEngine.register_prefix).
+ACADEMIC_SYSTEM_PROMPT = """<start_of_turn>user
+Eres "Titi", un asistente de investigación académica avanzado y riguroso.
+Tu tarea es responder a la orden del usuario utilizando ÚNICAMENTE la evidencia proporcionada.
 
-        compute_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float16
-        
-        
-        bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_compute_dtype=compute_dtype,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_use_double_quant=True,
-            )
-        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
-        self.model = AutoModelForCausalLM.from_pretrained(
-                MODEL_ID, 
-                quantization_config=bnb_config, 
-                device_map=self.device,
-                attn_implementation="sdpa"
-            )
-
-    def generate(self, prompt, max_tokens=1200):
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
-        input_len = inputs['input_ids'].shape[1]
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs, 
-                max_new_tokens=max_tokens,
-                temperature=0.4,
-                do_sample=True,
-                repetition_penalty=1.2,
-                pad_token_id=self.tokenizer.eos_token_id,
-            )
-        
-        generated_tokens = outputs[0][input_len:]
-        full_text = self.tokenizer.decode(generated_tokens, skip_special_tokens=True)
-        """
-        if "<start_of_turn>model" in full_text:
-            return full_text.split("<start_of_turn>model")[-1].strip()
-        return full_text.replace(prompt, "").strip()
-        """
-        # gestion de vram
-        del inputs, outputs
-        del generated_tokens
-        gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        return full_text.strip()
-    
-    def unload_model(self):
-        print(":/ Liberando modelo y limpiando VRAM...")
-        if hasattr(self, 'model'):
-            del self.model
-        if hasattr(self, 'tokenizer'):
-            del self.tokenizer
-        gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.ipc_collect()
-        print(":) VRAM liberada con éxito.")
+### REGLAS ESTRICTAS DE RESPUESTA:
+1. RIGOR ABSOLUTO: Usa exclusivamente la información de la "EVIDENCIA ENCONTRADA". Prohibido utilizar conocimiento externo no listado ahí.
+2. CITAS EN LÍNEA OBLIGATORIAS: Cada afirmación científica debe terminar con la cita correspondiente usando el número de la fuente en corchetes. Ejemplo: "El cambio climático afecta drásticamente la biodiversidad local [1]." o "Según el autor del documento [2]..."
+3. CERO ALUCINACIONES: Prohibido crear URLs, nombres de papers, fechas o autores que no estén explícitamente en la evidencia. Si la evidencia no responde a la orden, escribe: "La literatura encontrada no permite responder a esta solicitud."
+4. ESTILO: Tono académico, formal y directo. Sin saludos, sin presentarte. Devuelve el texto estructurado en párrafos listo para una tesis.
+
+"""
+
+LEGAL_SYSTEM_PROMPT = """<start_of_turn>user
+Eres "Titi", un abogado experto en derecho colombiano y redacción jurídica.
+Tu tarea es responder a la consulta jurídica basándote ÚNICAMENTE en la jurisprudencia proporcionada.
+
+### REGLAS ESTRICTAS DE RESPUESTA:
+1. CITAS EXACTAS FORZADAS: Cada argumento debe respaldarse citando el número de la fuente en corchetes al final de la oración. Ejemplo: "La Corte Constitucional protege el derecho fundamental a la salud [1]."
+2. FIDELIDAD ABSOLUTA: No inventes leyes, sentencias, ni artículos. Si la información no está en la jurisprudencia encontrada, di explícitamente: "No hay jurisprudencia en los resultados actuales para sustentar esto."
+3. LENGUAJE TÉCNICO: Usa jerga jurídica colombiana precisa (ej. exequibilidad, ratio decidendi, cosa juzgada).
+4. FORMATO: Responde directamente, sin preámbulos, sin decir "Hola" ni "Aquí tienes el análisis". Listo para pegar en el documento.
+
+"""
 
 class AgentOrchestrator:
     """
     Clase para coordinar las operaciones del agente.
     Gestiona la generación de queries, búsquedas web y la formulación de respuestas.
     """
-    def __init__(self):
+    def __init__(self, search_backend=None):
+        """
+        `search_backend(query, filters, max_results)` reemplaza a DuckDuckGo (p. ej. un backend falso en pruebas).
+        """
         self.llm = None 
+        self.embedder = None
+        self._llm_lock = threading.Lock()
+        self._embedder_lock = threading.Lock()
+        self.ready = False
+        self.warmup_timings = {}
+        # Progreso del arranque en segundo plano (lo reporta /health)
+        self.load_state = {"stage": "pendiente", "components": {}, "error": None}
+        self._load_started = None
+        # Ciclo de vida del modelo: peticiones en curso, última actividad, descargas/recargas
+        self._active_requests = 0
+        self._last_used = time.time()
+        self.lifecycle = {"unloads": 0, "reloads": 0, "last_reload_s": None, "total_reload_s": 0.0}
+        # Histogramas por etapa (/metrics) y trazas de las últimas peticiones (/traces)
+        self.metrics = PipelineMetrics()
         self.history_manager = HistoryManager()
+        self.search_cache = SearchCache(
+            ttl_seconds=SEARCH_CACHE_TTL_HOURS * 3600, max_entries=SEARCH_CACHE_MAX_ENTRIES
+        )
+        self.search_fanout = SearchFanout(search_backend or self._cached_search, deadline_s=SEARCH_DEADLINE_S)
+        self.semantic_index = SemanticIndex(embedder_fn=self.get_embedder)
+        self.reranker = SnippetReranker(
+            embedder_fn=self.get_embedder,
+            count_tokens=lambda text: self.get_llm().count_tokens(text),
+        )
+        self._summarizing = set()
+        self._summary_lock = threading.Lock()
+        self.prompt_builder = PromptBuilder(count_tokens=lambda text: self.get_llm().count_tokens(text))
+        self.query_builder = QueryBuilder(
+            QUERY_BUILDER_MODE,
+            llm_query_fn=self._generate_smart_query,
+            embedder_fn=self.get_embedder,
+        )
+
+    def start_loading(self):
+        """
+        Carga y calienta el modelo en un hilo de fondo; el servidor atiende mientras tanto
+        (historial, estáticos, /health con el progreso).
+        """
+        self._load_started = time.time()
+        threading.Thread(target=self._load_in_background, name="titi-startup", daemon=True).start()
+
+    def _load_in_background(self):
+        try:
+            self.load_state["stage"] = "cargando"
+            if PRELOAD_EMBEDDER:
+                # MiniLM se carga en paralelo con el LLM y no bloquea el arranque
+                threading.Thread(target=self._preload_embedder, name="titi-embedder", daemon=True).start()
+            self.get_llm()
+            self.load_state["stage"] = "calentando"
+            self.warm_up()
+            self.load_state["stage"] = "listo"
+            self._last_used = time.time()
+            if IDLE_UNLOAD_MINUTES:
+                threading.Thread(target=self._idle_loop, name="titi-idle", daemon=True).start()
+        except Exception as e:
+            self.load_state.update(stage="error", error=str(e))
+            print(f"!!! ERROR CARGANDO MODELO: {e}")
+            import traceback
+            traceback.print_exc()
+
+    def _preload_embedder(self):
+        try:
+            self.get_embedder()
+        except Exception as e:
+            print(f"  :/ No se pudo precargar el embedder (se reintentará al usarlo): {e}")
+
+    def _mark_loaded(self, component):
+        started = self._load_started or time.time()
+        self.load_state["components"][component] = round(time.time() - started, 1)
+
+    def load_status(self):
+        status = dict(self.load_state, components=dict(self.load_state["components"]))
+        if self._load_started:
+            status["elapsed_s"] = round(time.time() - self._load_started, 1)
+        return status
+
+    def warm_up(self):
+        """
+        Carga el modelo y lo calienta con los prefijos de ambos modos. Hasta que termina,
+        `ready` es False y /health responde 503.
+        """
+        llm = self.get_llm()
+        start = time.time()
+        print(":/ Calentando el modelo...")
+        self.warmup_timings = llm.warm_up(prefixes=(ACADEMIC_SYSTEM_PROMPT, LEGAL_SYSTEM_PROMPT))
+        self._mark_loaded("calentamiento")
+        self.ready = True
+        print(f":) Modelo caliente en {time.time() - start:.1f}s")
 
     def get_llm(self):
-        if self.llm is None:
-            self.llm = LLMEngine()
+        with self._llm_lock:
+            if self.llm is None:
+                reloading = self.lifecycle["unloads"] > 0
+                start = time.time()
+                # Import diferido: torch y transformers tardan varios segundos en importarse
+                from engine import create_llm_engine
+                if not reloading:
+                    self._mark_loaded("librerias")
+                llm = create_llm_engine()
+                if not reloading:
+                    self._mark_loaded("modelo")
+                for prefix in (ACADEMIC_SYSTEM_PROMPT, LEGAL_SYSTEM_PROMPT):
+                    llm.register_prefix(prefix)
+                self.llm = llm
+                if reloading:
+                    elapsed = round(time.time() - start, 2)
+                    self.lifecycle["reloads"] += 1
+                    self.lifecycle["last_reload_s"] = elapsed
+                    self.lifecycle["total_reload_s"] += elapsed
+                    self.metrics.model_reloads.inc()
+                    self.metrics.model_reload_seconds.observe(elapsed)
+                    print(f":) Modelo recargado en {elapsed}s")
+                else:
+                    self._mark_loaded("prefijos")
         return self.llm
 
+    @contextmanager
+    def _in_use(self):
+        """
+        Marca una petición en curso: el modelo no se descarga mientras haya alguna.
+        """
+        with self._llm_lock:
+            self._active_requests += 1
+            self._last_used = time.time()
+        try:
+            yield
+        finally:
+            with self._llm_lock:
+                self._active_requests -= 1
+                self._last_used = time.time()
+
+    def _idle_loop(self):
+        while True:
+            time.sleep(IDLE_CHECK_INTERVAL_S)
+            try:
+                self._unload_if_idle()
+            except Exception as e:
+                print(f"  :/ Error revisando inactividad del modelo: {e}")
+
+    def _unload_if_idle(self):
+        """
+        Descarga el modelo tras IDLE_UNLOAD_MINUTES sin peticiones, o tras PRESSURE_UNLOAD_MINUTES
+        si la GPU está casi llena por otros programas. La próxima petición lo recarga.
+        """
+        with self._llm_lock:
+            if self.llm is None or self._active_requests or self._summarizing:
+                return False
+            idle_minutes = (time.time() - self._last_used) / 60
+            fractions = self.llm.memory_fractions() if hasattr(self.llm, "memory_fractions") else None
+            # Un modelo grande solo en la GPU también la deja casi llena: eso no es presión
+            under_pressure = (fractions is not None and fractions[0] < PRESSURE_FREE_FRACTION
+                              and fractions[1] >= PRESSURE_OTHERS_FRACTION)
+            if idle_minutes < IDLE_UNLOAD_MINUTES and not (under_pressure and idle_minutes >= PRESSURE_UNLOAD_MINUTES):
+                return False
+            reason = "memoria del dispositivo baja" if under_pressure else "inactividad"
+            print(f":/ Descargando el modelo por {reason} ({idle_minutes:.0f} min sin uso)...")
+            llm, self.llm = self.llm, None
+            llm.unload_model()
+            self.lifecycle["unloads"] += 1
+            self.metrics.model_unloads.inc(reason="memory_pressure" if under_pressure else "idle")
+        return True
+
+    def get_embedder(self):
+        """
+        MiniLM (queries, reranking, índice local), cargado al primer uso.
+        """
+        with self._embedder_lock:
+            if self.embedder is None:
+                from sentence_transformers import SentenceTransformer
+                self.embedder = SentenceTransformer(EMBEDDER_ID, device='cpu')
+                self._mark_loaded("embedder")
+        return self.embedder
+
     def _generate_smart_query(self, selection, instruction, history_context="",search_type='academic'):
         """
         Lógica Determinista: Si no hay selección, usa la instrucción directa.
@@ -147,25 +335,107 @@ Query:<end_of_turn><start_of_turn>model"""
     def _safe_ddg_search(self, query, max_results=5, max_retries=3):
         """
         Maneja los bloqueos por Rate Limit (HTTP 429) y desconexiones de red.
+        Dentro del abanico de búsquedas no reintenta ni espera más allá del plazo global:
+        el hilo del pool queda libre para las búsquedas que sí llegan a tiempo.
         """
+        trace = current_trace()
         for attempt in range(max_retries):
+            time_left = search_time_left()
+            if time_left is not None and time_left <= 0:
+                print(f"  :/ Búsqueda descartada: venció el plazo antes de empezar ({query[:60]})")
+                return []
+            start = time.perf_counter()
             try:
+                from ddgs import DDGS
                 with DDGS() as ddgs:
                     results = list(ddgs.text(query, max_results=max_results))
                     valid_results =[r for r in results if r.get('body') and len(r.get('body').strip()) > 20]
+                    if trace is not None:
+                        trace.event("search_attempt", query=query, attempt=attempt + 1, outcome="ok",
+                                    seconds=round(time.perf_counter() - start, 4), results=len(valid_results))
                     return valid_results
                     
             except Exception as e:
                 print(f"  :/ Advertencia de Red: Fallo en DDG (intento {attempt + 1}/{max_retries}). Error: {e}")
+                if trace is not None:
+                    trace.event("search_attempt", query=query, attempt=attempt + 1, outcome="error",
+                                seconds=round(time.perf_counter() - start, 4), error=str(e)[:200])
+                time_left = search_time_left()
+                if attempt < max_retries - 1 and time_left is not None and time_left <= 2 ** attempt:
+                    print("  :/ Sin reintento: el plazo de búsqueda vence antes del backoff.")
+                    return []
                 if attempt < max_retries - 1:
                     sleep_time = 2 ** attempt
                     print(f"  :/ Esperando {sleep_time} segundos para evadir el bloqueo...")
+                    if trace is not None:
+                        trace.event("search_backoff", query=query, seconds=sleep_time)
                     time.sleep(sleep_time)
                 else:
                     print("  [!] ERROR CRÍTICO: DuckDuckGo bloqueó la búsqueda temporalmente o no hay conexión.")
                     return []
         return[]
 
+    def _cached_search(self, query, filters, max_results=MAX_DOCS):
+        """
+        Consulta primero el cache en disco; solo va a la red si no hay entrada vigente.
+        Las búsquedas vacías no se guardan (pueden deberse a un bloqueo temporal).
+        """
+        results = self.search_cache.get(query, filters, max_results)
+        if results is not None:
+            print(f"  :) Resultados desde cache: {query}")
+            trace = current_trace()
+            if trace is not None:
+                trace.event("search_cache_hit", query=query, filters=filters)
+            return results
+        results = self._safe_ddg_search(f"{query} {filters}", max_results=max_results)
+        if results:
+            self.search_cache.put(query, filters, max_results, results)
+        return results
+
+    def _retrieve(self, query, jobs, mode, interleave=False):
+        """
+        Recupera evidencia: primero el índice local; la red solo si lo local no basta.
+        Si la red no devuelve nada (sin conexión), se usa lo que haya en el índice.
+        """
+        local = self.semantic_index.search(query, k=LOCAL_INDEX_K, min_score=LOCAL_INDEX_MIN_SCORE, mode=mode)
+        local_results = [
+            {"title": m.get("title", ""), "body": m["text"], "href": m.get("href", "")} for _, m in local
+        ]
+        strong = [score for score, _ in local if score >= LOCAL_INDEX_SKIP_WEB_SCORE]
+        if len(strong) >= LOCAL_INDEX_SKIP_WEB_HITS:
+            print(f"  :) {len(strong)} fuentes locales cubren la consulta; se omite la búsqueda web.")
+            return local_results
+
+        web = self.search_fanout.search(jobs, max_results=MAX_DOCS, interleave=interleave)
+        if web:
+            self._index_in_background([
+                {"text": r.get("body", ""), "title": r.get("title", ""), "href": r.get("href", ""),
+                 "kind": "snippet", "mode": mode}
+                for r in web
+            ])
+        elif local_results:
+            print("  :/ Sin resultados de la red; usando evidencia local.")
+        return merge_results([web, local_results], MAX_DOCS + len(local_results))
+
+    def _index_in_background(self, items):
+        def _run():
+            try:
+                self.semantic_index.add(items)
+            except Exception as e:
+                print(f"  :/ No se pudo actualizar el índice local: {e}")
+        threading.Thread(target=_run, daemon=True).start()
+
+    def _index_answer(self, conversation_id, instruction, answer, mode):
+        mode = 'academic' if mode == 'academic' else 'legal'
+        self._index_in_background([{
+            "text": answer,
+            "title": f"Respuesta previa de Titi: {instruction[:60]}",
+            "href": f"titi://conversacion/{conversation_id}",
+            "kind": "answer",
+            "mode": mode,
+            "conversation_id": conversation_id,
+        }])
+
     
     def _search_legal(self, query):
         """
@@ -174,12 +444,12 @@ Query:<end_of_turn><start_of_turn>model"""
         print(f":) Titi Buscando (Modo JURÍDICO): {query}")
         context = []
         try:
-            ddgs = DDGS()
-            # Filtro estricto para SUIN y Altas Cortes
-            legal_filters = '(site:suin-juriscol.gov.co OR site:corteconstitucional.gov.co OR site:cortesuprema.gov.co OR site:consejodeestado.gov.co OR site:funcionpublica.gov.co)'
-            full_query = f"{query} {legal_filters}"
-            
-            results = self._safe_ddg_search(full_query, max_results=MAX_DOCS)
+            # Una búsqueda por sitio (SUIN y Altas Cortes), todas en paralelo y alternadas al fusionar
+            jobs = [(query, f"site:{site}") for site in LEGAL_SITES]
+            with stage("search"):
+                results = self._retrieve(query, jobs, 'legal', interleave=True)
+            with stage("rerank"):
+                results = self.reranker.rerank(query, results, body_chars=600)
             
             for i, r in enumerate(results):
                 title = r.get('title', 'Documento Jurídico')
@@ -212,24 +482,17 @@ Query:<end_of_turn><start_of_turn>model"""
         1. filetype:pdf AND "references"
         2. site:edu OR site:org
         3. site:arxiv.org
-        4. Fallback si no hay resultados.
+        4. Búsqueda relajada en paralelo, que completa lo que falte.
         """
         print(f":) Titi Buscando (Modo Académico): {query}")
         context = []
         try:
-            ddgs = DDGS()
-            
-            academic_filters = 'filetype:pdf -site:academia.edu -site:researchgate.net (site:edu.co OR site:sciencedirect.com OR site:arxiv.org OR site:scielo.org OR site:redalyc.org OR site:dialnet.unirioja.es)'
-            full_query = f"{query} {academic_filters}"
-            
-            # Búsqueda estricta
-            results = self._safe_ddg_search(full_query, max_results=MAX_DOCS)
-            
-            # Si la búsqueda estricta falla, relajamos un poco
-            if not results:
-                print(":/ Sin resultados estrictos. Relajando filtros...")
-                fallback_query = f"{query} research paper filetype:pdf -site:academia.edu -site:researchgate.net"
-                results = list(ddgs.text(fallback_query, max_results=MAX_DOCS))
+            # Búsqueda estricta y relajada a la vez; los resultados estrictos tienen prioridad
+            jobs = [(query, ACADEMIC_FILTERS), (query, ACADEMIC_FALLBACK_FILTERS)]
+            with stage("search"):
+                results = self._retrieve(query, jobs, 'academic')
+            with stage("rerank"):
+                results = self.reranker.rerank(query, results, body_chars=500)
 
             # Procesamiento de resultados
             for i, r in enumerate(results):
@@ -258,103 +521,217 @@ Query:<end_of_turn><start_of_turn>model"""
             
         return "\n".join(context)
     
-    def _format_history(self, messages):
+    def _history_turns(self, data):
         """
-        Formatea el historial de mensajes para incluir en el prompt.
+        Historial para el prompt (un item por turno): el resumen de los turnos viejos,
+        si existe, y los mensajes recientes que aún no están resumidos.
         """
-        recent = messages[-MAX_HISTORY_TURNS:]
-        formatted = ""
+        summary = data.get("summary")
+        start = data.get("summary_upto", 0) if summary else 0
+        recent = data["messages"][start:][-MAX_HISTORY_TURNS:]
+        turns = []
+        if summary:
+            turns.append(f"<start_of_turn>user\nResumen de la conversación anterior:\n{summary}<end_of_turn>\n")
         for turn in recent:
             role = "user" if turn['role'] == 'user' else "model"
-            formatted += f"<start_of_turn>{role}\n{turn['content']}<end_of_turn>\n"
-        return formatted
+            turns.append(f"<start_of_turn>{role}\n{turn['content']}<end_of_turn>\n")
+        return turns
 
-    def process_titi_task(self, selection, instruction, conversation_id=None, mode='academic'):
-        print(":) Titi procesando tarea...")
-        if not conversation_id:
-            conversation_id, data = self.history_manager.create_conversation()
-        else:
-            data = self.history_manager.load_conversation(conversation_id)
-            if not data:
-                conversation_id, data = self.history_manager.create_conversation()
-        
-        # Agregar el nuevo mensaje al historial
-        self.history_manager.add_message(conversation_id,"user", f"{selection}\n\n{instruction}".strip())
-
-        # ultimos 2 mensajes para contexto de busqueda
-        history_text = " ".join([m["content"] for m in data["messages"][-2:]])
-
-        # Titi piensa la búsqueda
-        search_query = self._generate_smart_query(selection, instruction, history_text, search_type=mode)
-        
-        # Titi busca en la red
-        if mode != 'academic':
-            context_data = self._search_legal(search_query)
-            history_block = self._format_history(data["messages"][:-1])
-            # promt
-            final_prompt = f"""<start_of_turn>user
-Eres "Titi", un abogado experto en derecho colombiano y redacción jurídica.
-Tu tarea es responder a la consulta jurídica basándote ÚNICAMENTE en la jurisprudencia proporcionada.
+    def _summarize_in_background(self, conversation_id):
+        """
+        Tras cada respuesta, resume en segundo plano los turnos anteriores al último intercambio
+        si lo no resumido ya es largo. Como mucho un resumen en curso por conversación.
+        """
+        if not ENABLE_HISTORY_SUMMARY:
+            return
+        with self._summary_lock:
+            if conversation_id in self._summarizing:
+                return
+            self._summarizing.add(conversation_id)
+
+        def _run():
+            try:
+                self._update_summary(conversation_id)
+            except Exception as e:
+                print(f"  :/ No se pudo resumir el historial: {e}")
+            finally:
+                with self._summary_lock:
+                    self._summarizing.discard(conversation_id)
+        threading.Thread(target=_run, daemon=True).start()
+
+    def _update_summary(self, conversation_id):
+        data = self.history_manager.load_conversation(conversation_id)
+        if not data:
+            return
+        messages = data["messages"]
+        upto = data.get("summary_upto", 0)
+        target = len(messages) - SUMMARY_KEEP_MESSAGES
+        if target <= upto:
+            return
+        pending = messages[upto:]
+        if len(pending) <= MAX_HISTORY_TURNS:
+            pending_tokens = self.prompt_builder.count_tokens("".join(m['content'] for m in pending))
+            if pending_tokens < SUMMARY_TRIGGER_TOKENS:
+                return
+
+        new_turns = []
+        for m in messages[upto:target]:
+            speaker = "Usuario" if m['role'] == 'user' else "Titi"
+            content = self.prompt_builder.truncate(m['content'], SUMMARY_TURN_MAX_TOKENS)
+            new_turns.append(f"{speaker}: {content}\n")
+        prompt = self.prompt_builder.build(
+            SUMMARY_PROMPT,
+            [
+                PromptSection("resumen previo", "### RESUMEN PREVIO:\n{content}\n\n",
+                              text=data.get("summary") or "(ninguno)", priority=0),
+                PromptSection("turnos nuevos", "### TURNOS NUEVOS:\n{content}\n",
+                              items=new_turns, joiner="", priority=1, drop_from="start"),
+            ],
+            "Resumen actualizado:<end_of_turn>\n<start_of_turn>model\n",
+            reserve_tokens=SUMMARY_MAX_TOKENS,
+        )
+        start = time.time()
+        summary = self._generate_when_idle(prompt, SUMMARY_MAX_TOKENS)
+        if summary is None:
+            print("  :/ Resumen del historial pospuesto: el modelo siguió ocupado.")
+            return
+        if summary:
+            self.history_manager.update_metadata(conversation_id, touch=False, summary=summary, summary_upto=target)
+            print(f"  :) Historial resumido hasta el mensaje {target} en {time.time() - start:.1f}s")
+
+    def _generate_when_idle(self, prompt, max_tokens):
+        """
+        Generación de baja prioridad: arranca cuando no hay peticiones en curso y se corta
+        (liberando el lock de generación) en cuanto llega una. None si no alcanzó a terminar.
+        """
+        deadline = time.time() + SUMMARY_MAX_WAIT_S
+        while time.time() < deadline:
+            if self._active_requests:
+                time.sleep(SUMMARY_IDLE_POLL_S)
+                continue
+            stream = self.get_llm().generate_stream(prompt, max_tokens=max_tokens)
+            parts = []
+            try:
+                for chunk in stream:
+                    if self._active_requests:
+                        break
+                    parts.append(chunk)
+                else:
+                    return "".join(parts).strip()
+            finally:
+                stream.close()
+        return None
 
-### NORMATIVA Y JURISPRUDENCIA ENCONTRADA:
-"{context_data}"
+    def _begin_task(self, selection, instruction, conversation_id):
+        """
+        Abre (o crea) la conversación y registra el mensaje del usuario.
+        """
+        with stage("history"):
+            if not conversation_id:
+                conversation_id, data = self.history_manager.create_conversation()
+            else:
+                data = self.history_manager.load_conversation(conversation_id)
+                if not data:
+                    conversation_id, data = self.history_manager.create_conversation()
 
-### TEXTO DEL DOCUMENTO (Contexto):
-"{selection}"
+            # Agregar el nuevo mensaje al historial
+            self.history_manager.add_message(conversation_id,"user", f"{selection}\n\n{instruction}".strip())
+        return conversation_id, data
 
-### HISTORIAL DE CHAT:
-{history_block}
+    def _finish_task(self, conversation_id, instruction, response, context_data, final_prompt, mode):
+        """
+        Guarda la respuesta y lanza el indexado y el resumen en segundo plano.
+        """
+        with stage("history"):
+            self.history_manager.add_message(conversation_id, "assistant", response, sources=context_data, thought=final_prompt)
+        self._index_answer(conversation_id, instruction, response, mode)
+        self._summarize_in_background(conversation_id)
 
-### CONSULTA JURÍDICA:
-"{instruction}"
+    def _record_trace(self, trace, status):
+        trace.finish(status)
+        try:
+            self.metrics.record(trace)
+        except Exception as e:
+            print(f"  :/ No se pudo registrar la traza: {e}")
 
-### REGLAS ESTRICTAS DE RESPUESTA:
-1. CITAS EXACTAS FORZADAS: Cada argumento debe respaldarse citando el número de la fuente en corchetes al final de la oración. Ejemplo: "La Corte Constitucional protege el derecho fundamental a la salud [1]."
-2. FIDELIDAD ABSOLUTA: No inventes leyes, sentencias, ni artículos. Si la información no está en la jurisprudencia encontrada, di explícitamente: "No hay jurisprudencia en los resultados actuales para sustentar esto."
-3. LENGUAJE TÉCNICO: Usa jerga jurídica colombiana precisa (ej. exequibilidad, ratio decidendi, cosa juzgada).
-4. FORMATO: Responde directamente, sin preámbulos, sin decir "Hola" ni "Aquí tienes el análisis". Listo para pegar en el documento.
+    def _build_final_prompt(self, search_query, selection, instruction, data, mode):
+        """
+        Busca la evidencia según el modo y arma el prompt final dentro del presupuesto de tokens.
+        Retorna (context_data, final_prompt).
+        """
+        # `data` se cargó antes de registrar el mensaje actual: son solo los turnos previos
+        history = PromptSection("historial", "### HISTORIAL DE CHAT:\n{content}\n\n",
+                                items=self._history_turns(data), joiner="",
+                                priority=3, drop_from="start")
 
-Respuesta Jurídica:<end_of_turn>
-<start_of_turn>model"""
+        # Titi busca en la red
+        if mode != 'academic':
+            context_data = self._search_legal(search_query)
+            # promt: prefijo fijo (cacheado) + parte variable
+            # El historial va justo después del prefijo: entre turnos de la misma
+            # conversación esa parte se comparte y su KV-cache se reutiliza.
+            prefix = LEGAL_SYSTEM_PROMPT
+            sections = [
+                history,
+                PromptSection("normativa", '### NORMATIVA Y JURISPRUDENCIA ENCONTRADA:\n"{content}"\n\n',
+                              items=split_sources(context_data), priority=2, min_tokens=EVIDENCE_MIN_TOKENS),
+                PromptSection("documento", '### TEXTO DEL DOCUMENTO (Contexto):\n"{content}"\n\n',
+                              text=selection, priority=1, min_tokens=SELECTION_MIN_TOKENS),
+                PromptSection("consulta", '### CONSULTA JURÍDICA:\n"{content}"\n\n',
+                              text=instruction, priority=0),
+            ]
+            suffix = "Respuesta Jurídica:<end_of_turn>\n<start_of_turn>model"
         
         else:
             context_data = self._search_web(search_query)
 
-            # Guardar la evidencia en el historial
-            history_block = self._format_history(data["messages"][:-1])
+            # Prompt final Titi: prefijo fijo (cacheado) + parte variable
+            prefix = ACADEMIC_SYSTEM_PROMPT
+            sections = [
+                history,
+                PromptSection("evidencia", "### EVIDENCIA ENCONTRADA (Papers y Artículos):\n{content}\n\n",
+                              items=split_sources(context_data), priority=2, min_tokens=EVIDENCE_MIN_TOKENS),
+                PromptSection("texto", '### TEXTO DEL USUARIO (Contexto base):\n"{content}"\n\n',
+                              text=selection, priority=1, min_tokens=SELECTION_MIN_TOKENS),
+                PromptSection("orden", '### ORDEN DEL USUARIO:\n"{content}"\n'
+                              "(Si la orden está vacía, analiza y expande el texto académicamente).\n\n",
+                              text=instruction, priority=0),
+            ]
+            suffix = "Respuesta Académica:<end_of_turn>\n<start_of_turn>model\n"
+
+        with stage("prompt"):
+            final_prompt = self.prompt_builder.build(prefix, sections, suffix, reserve_tokens=ANSWER_MAX_TOKENS)
+        return context_data, final_prompt
 
-            # Prompt final Titi
-            final_prompt = f"""<start_of_turn>user
-Eres "Titi", un asistente de investigación académica avanzado y riguroso.
-Tu tarea es responder a la orden del usuario utilizando ÚNICAMENTE la evidencia proporcionada.
-
-### EVIDENCIA ENCONTRADA (Papers y Artículos):
-{context_data}
-
-### HISTORIAL DE CHAT:
-{history_block}
+    def process_titi_task(self, selection, instruction, conversation_id=None, mode='academic'):
+        print(":) Titi procesando tarea...")
+        trace = RequestTrace('academic' if mode == 'academic' else 'legal')
+        status = "error"
+        try:
+            with self._in_use(), trace.activate():
+                result = self._process_titi_task(selection, instruction, conversation_id, mode, trace)
+            status = "ok"
+            return result
+        finally:
+            self._record_trace(trace, status)
 
-### TEXTO DEL USUARIO (Contexto base):
-"{selection}"
+    def _process_titi_task(self, selection, instruction, conversation_id, mode, trace):
+        conversation_id, data = self._begin_task(selection, instruction, conversation_id)
 
-### ORDEN DEL USUARIO:
-"{instruction}"
-(Si la orden está vacía, analiza y expande el texto académicamente).
+        # ultimos 2 mensajes para contexto de busqueda
+        history_text = " ".join([m["content"] for m in data["messages"][-2:]])
 
-### REGLAS ESTRICTAS DE RESPUESTA:
-1. RIGOR ABSOLUTO: Usa exclusivamente la información de la "EVIDENCIA ENCONTRADA". Prohibido utilizar conocimiento externo no listado ahí.
-2. CITAS EN LÍNEA OBLIGATORIAS: Cada afirmación científica debe terminar con la cita correspondiente usando el número de la fuente en corchetes. Ejemplo: "El cambio climático afecta drásticamente la biodiversidad local [1]." o "Según el autor del documento [2]..."
-3. CERO ALUCINACIONES: Prohibido crear URLs, nombres de papers, fechas o autores que no estén explícitamente en la evidencia. Si la evidencia no responde a la orden, escribe: "La literatura encontrada no permite responder a esta solicitud."
-4. ESTILO: Tono académico, formal y directo. Sin saludos, sin presentarte. Devuelve el texto estructurado en párrafos listo para una tesis.
+        # Titi piensa la búsqueda
+        with stage("query"):
+            search_query = self.query_builder.build(selection, instruction, history_text, search_type=mode)
+        context_data, final_prompt = self._build_final_prompt(search_query, selection, instruction, data, mode)
 
-Respuesta Académica:<end_of_turn>
-<start_of_turn>model
-"""
         # Titi genera la respuesta final
-        response = self.get_llm().generate(final_prompt, max_tokens=2000)
+        response = self.get_llm().generate(final_prompt, max_tokens=ANSWER_MAX_TOKENS, session_id=conversation_id,
+                                           trace=trace)
 
         # Guardar la respuesta en el historial
-        self.history_manager.add_message(conversation_id, "assistant", response, sources=context_data, thought=final_prompt)
+        self._finish_task(conversation_id, instruction, response, context_data, final_prompt, mode)
         
         return {
             "conversation_id": conversation_id,
@@ -362,17 +739,101 @@ Respuesta Académica:<end_of_turn>
             "answer": response,
             "sources": context_data
         }
+
+    def process_titi_task_stream(self, selection, instruction, conversation_id=None, mode='academic'):
+        """
+        Variante de process_titi_task que produce eventos a medida que avanza:
+        meta -> query -> sources -> token (n veces) -> done.
+        """
+        print(":) Titi procesando tarea (streaming)...")
+        trace = RequestTrace('academic' if mode == 'academic' else 'legal', stream=True)
+        status = "error"
+        try:
+            with self._in_use():
+                yield from self._process_titi_task_stream(selection, instruction, conversation_id, mode, trace)
+            status = "ok"
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        finally:
+            self._record_trace(trace, status)
+
+    def _process_titi_task_stream(self, selection, instruction, conversation_id, mode, trace):
+        # Cada paso del generador puede correr en otro hilo: la traza se activa por tramos,
+        # sin abarcar ningún yield.
+        with trace.activate():
+            conversation_id, data = self._begin_task(selection, instruction, conversation_id)
+        yield {"type": "meta", "conversation_id": conversation_id}
+
+        with trace.activate(), stage("query"):
+            history_text = " ".join([m["content"] for m in data["messages"][-2:]])
+            search_query = self.query_builder.build(selection, instruction, history_text, search_type=mode)
+        yield {"type": "query", "query": search_query}
+
+        with trace.activate():
+            context_data, final_prompt = self._build_final_prompt(search_query, selection, instruction, data, mode)
+        yield {"type": "sources", "sources": context_data, "thought": final_prompt}
+
+        chunks = []
+        for chunk in self.get_llm().generate_stream(final_prompt, max_tokens=ANSWER_MAX_TOKENS,
+                                                    session_id=conversation_id, trace=trace):
+            chunks.append(chunk)
+            yield {"type": "token", "text": chunk}
+        response = "".join(chunks).strip()
+
+        with trace.activate():
+            self._finish_task(conversation_id, instruction, response, context_data, final_prompt, mode)
+        yield {
+            "type": "done",
+            "conversation_id": conversation_id,
+            "answer": response,
+        }
+
     def cleanup(self):
         if self.llm is not None:
             self.llm.unload_model()
             self.llm = None
 
-    def get_history_list(self):
-        return self.history_manager.list_conversations()
+    def get_stats(self):
+        """
+        Estado del motor: ciclo de vida (descargas/recargas), allocator/limpiezas de memoria
+        y métricas de especulación.
+        """
+        lifecycle = dict(self.lifecycle, idle_s=round(time.time() - self._last_used, 1),
+                         active_requests=self._active_requests)
+        if self.llm is None:
+            return {"model_loaded": False, "lifecycle": lifecycle}
+        stats = {"model_loaded": True, "device": self.llm.device, "lifecycle": lifecycle}
+        if getattr(self.llm, "memory", None) is not None:
+            stats["memory"] = self.llm.memory.stats()
+        if hasattr(self.llm, "speculation_stats"):
+            stats["speculation"] = self.llm.speculation_stats()
+        return stats
+
+    def get_metrics(self):
+        """
+        Texto de exposición de Prometheus: latencias por etapa y modo, búsquedas, tokens.
+        """
+        return self.metrics.render()
+
+    def get_traces(self, limit=20):
+        return self.metrics.recent_traces(limit)
+
+    def get_history_list(self, limit=None, offset=0):
+        return self.history_manager.list_conversations(limit=limit, offset=offset)
     
     def delete_history(self, cid):
+        if self.llm is not None and self.llm.session_cache is not None:
+            self.llm.session_cache.discard(cid)
+        self.semantic_index.remove(cid)
         return self.history_manager.delete_conversation(cid)
     
     def get_conversation_details(self, cid):
         return self.history_manager.load_conversation(cid)
 
+
+    def get_conversation_page(self, cid, limit, before=None, include=()):
+        return self.history_manager.get_messages(cid, limit=limit, before=before, include=include)
+
+    def get_message_details(self, cid, index):
+        return self.history_manager.get_message_details(cid, index)
@@ -0,0 +1,90 @@
+import gzip
+import hashlib
+import os
+import uuid
+
+BLOB_COMPRESS_LEVEL = 6
+
+
+class BlobStore:
+    """
+    Almacén de textos grandes (prompts completos, fuentes) direccionado por contenido.
+    Cada blob se guarda comprimido con gzip en {blob_dir}/ab/cdef....gz, donde el nombre
+    es su SHA-256: el mismo texto se guarda una sola vez.
+    """
+    def __init__(self, blob_dir="data/blobs"):
+        self.blob_dir = blob_dir
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest[2:] + ".gz")
+
+    def put(self, text):
+        """
+        Guarda el texto (si no existía) y retorna su referencia 'sha256:<hex>'.
+        """
+        raw = text.encode("utf-8")
+        digest = hashlib.sha256(raw).hexdigest()
+        ref = f"sha256:{digest}"
+        path = self._path(digest)
+        try:
+            # Ya existía: se marca como recién usado para que delete() no lo borre
+            # si otra conversación lo referenció después del barrido
+            os.utime(path)
+            return ref
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Temporal + os.replace: un lector nunca ve un blob a medio escribir
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(gzip.compress(raw, compresslevel=BLOB_COMPRESS_LEVEL, mtime=0))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return ref
+
+    def get(self, ref):
+        """
+        Retorna el texto de una referencia, o None si el blob no existe.
+        """
+        if not ref or not ref.startswith("sha256:"):
+            return None
+        path = self._path(ref.split(":", 1)[1])
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return gzip.decompress(f.read()).decode("utf-8")
+
+    def delete(self, refs, unused_since=None):
+        """
+        Borra los blobs de las referencias dadas. Con `unused_since` (epoch) se respetan
+        los que put() volvió a usar después de ese instante. Retorna cuántos se borraron.
+        """
+        removed = 0
+        for ref in refs:
+            if not ref or not ref.startswith("sha256:"):
+                continue
+            path = self._path(ref.split(":", 1)[1])
+            try:
+                if unused_since is not None and os.stat(path).st_mtime >= unused_since:
+                    continue
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+    def all_refs(self):
+        """
+        Referencias de todos los blobs guardados.
+        """
+        refs = set()
+        for prefix in os.listdir(self.blob_dir):
+            subdir = os.path.join(self.blob_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if name.endswith(".gz"):
+                    refs.add(f"sha256:{prefix}{name[:-3]}")
+        return refs
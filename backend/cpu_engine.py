@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+from metrics import record_generation
+
+GGUF_MODEL_PATH = "data/models/manaba_gemma_2_2b.Q4_K_M.gguf"
+GGUF_CONTEXT_TOKENS = 8192
+GGUF_THREADS = None  # None = todos los núcleos físicos que detecte llama.cpp
+GGUF_PROMPT_CACHE_MB = 512
+
+
+class GGUFEngine:
+    """
+    Motor de inferencia en CPU sobre llama.cpp (llama-cpp-python) con un modelo GGUF cuantizado.
+    Cumple el mismo contrato que LLMEngine: generate, generate_stream, count_tokens,
+    register_prefix y unload_model.
+
+    El GGUF se obtiene convirtiendo el modelo de Hugging Face con las herramientas de llama.cpp:
+        python convert_hf_to_gguf.py <modelo> --outfile manaba.f16.gguf
+        llama-quantize manaba.f16.gguf manaba_gemma_2_2b.Q4_K_M.gguf Q4_K_M
+    """
+    def __init__(self, model_path=GGUF_MODEL_PATH, n_ctx=GGUF_CONTEXT_TOKENS, n_threads=GGUF_THREADS):
+        try:
+            from llama_cpp import Llama, LlamaRAMCache
+        except ImportError:
+            raise RuntimeError("El backend GGUF requiere llama-cpp-python (pip install llama-cpp-python).")
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"No se encontró el modelo GGUF en {model_path}")
+
+        print(f":) Titi Cargando en cpu (GGUF: {os.path.basename(model_path)})...")
+        self.device = "cpu"
+        self.session_cache = None
+        self.model = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, verbose=False)
+        # Cache de estados KV por prefijo: los prompts con el mismo prefijo de sistema
+        # (o el mismo historial) no vuelven a hacer prefill de esa parte.
+        self.model.set_cache(LlamaRAMCache(capacity_bytes=GGUF_PROMPT_CACHE_MB * 1024 * 1024))
+        # llama.cpp no admite llamadas concurrentes sobre el mismo contexto
+        self._generate_lock = threading.Lock()
+
+    def register_prefix(self, text):
+        """
+        Precalienta la cache de llama.cpp con el prefijo de sistema.
+        """
+        with self._generate_lock:
+            self.model.create_completion(text, max_tokens=1)
+
+    def count_tokens(self, text):
+        return len(self.model.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def _generation_kwargs(self, max_tokens):
+        """
+        Los mismos parámetros de muestreo que LLMEngine.
+        """
+        return {
+            "max_tokens": max_tokens,
+            "temperature": 0.4,
+            "top_k": 50,
+            "top_p": 1.0,
+            "repeat_penalty": 1.2,
+        }
+
+    def generate(self, prompt, max_tokens=1200, session_id=None, trace=None):
+        queued = time.perf_counter()
+        with self._generate_lock:
+            record_generation(trace, queue_s=time.perf_counter() - queued)
+            self._reset_perf()
+            output = self.model.create_completion(prompt, **self._generation_kwargs(max_tokens))
+            self._record_perf(trace, prompt)
+        return output["choices"][0]["text"].strip()
+
+    def generate_stream(self, prompt, max_tokens=1200, session_id=None, trace=None):
+        """
+        Produce la respuesta por fragmentos a medida que se generan.
+        """
+        queued = time.perf_counter()
+        with self._generate_lock:
+            record_generation(trace, queue_s=time.perf_counter() - queued)
+            self._reset_perf()
+            for chunk in self.model.create_completion(prompt, stream=True, **self._generation_kwargs(max_tokens)):
+                text = chunk["choices"][0]["text"]
+                if text:
+                    yield text
+            self._record_perf(trace, prompt)
+
+    def _reset_perf(self):
+        from llama_cpp import llama_perf_context_reset
+        llama_perf_context_reset(self.model._ctx.ctx)
+
+    def _record_perf(self, trace, prompt):
+        """
+        Tiempos que mide el propio llama.cpp: prefill (solo los tokens que no estaban en la
+        cache de prefijos) y decodificación.
+        """
+        if trace is None:
+            return
+        from llama_cpp import llama_perf_context
+        perf = llama_perf_context(self.model._ctx.ctx)
+        prompt_tokens = self.count_tokens(prompt)
+        # El primer token sale de los logits del prefill: n_eval cuenta los siguientes
+        record_generation(
+            trace, prompt_tokens=prompt_tokens, cached_tokens=max(prompt_tokens - perf.n_p_eval, 0),
+            prefill_s=perf.t_p_eval_ms / 1000, decode_s=perf.t_eval_ms / 1000, decode_tokens=perf.n_eval + 1,
+        )
+
+    def warm_up(self, prefixes=("",), buckets=(64, 512, 2048), decode_tokens=8):
+        """
+        Corre prompts sintéticos de varios largos (mapea los pesos y llena la cache de prefijos).
+        """
+        filler_ids = self.model.tokenize("Texto de calentamiento del modelo. ".encode("utf-8"), add_bos=False)
+        room = self.model.n_ctx() - decode_tokens - max(self.count_tokens(p) for p in prefixes) - 16
+        timings = {}
+        for length in buckets:
+            ids = (filler_ids * (length // len(filler_ids) + 1))[:min(length, room)]
+            filler = self.model.detokenize(ids).decode("utf-8", errors="ignore")
+            start = time.time()
+            for prefix in prefixes:
+                self.generate(prefix + filler + "<end_of_turn>\n<start_of_turn>model\n", max_tokens=decode_tokens)
+            timings[length] = round(time.time() - start, 3)
+            print(f"  :) Calentamiento {length} tokens: {timings[length]}s")
+        return timings
+
+    def unload_model(self):
+        print(":/ Liberando modelo GGUF...")
+        if getattr(self, 'model', None) is not None:
+            self.model.close()
+            self.model = None
+        print(":) Modelo liberado con éxito.")
@@ -0,0 +1,580 @@
+import torch
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, DynamicCache,
+    TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList,
+)
+from transformers.generation.streamers import BaseStreamer
+from scheduler import BatchScheduler
+from session_cache import SessionCache, common_prefix_len, slice_cache
+from cpu_engine import GGUFEngine, GGUF_MODEL_PATH
+from memory_policy import MemoryPolicy
+from metrics import record_generation
+import os
+import copy
+import json
+import shutil
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MODEL_ID = "NicolasRodriguez/manaba_gemma_2_2b" 
+# "transformers" (GPU, 4-bit bitsandbytes), "gguf" (CPU, llama.cpp) o "auto":
+# GGUF si no hay CUDA y existe el modelo en GGUF_MODEL_PATH (ver cpu_engine.py)
+INFERENCE_BACKEND = "auto"
+
+# Calentamiento al arrancar: prompts sintéticos de estos largos (tokens) por cada prefijo
+WARMUP_BUCKETS = (64, 512, 2048, 4096)
+WARMUP_DECODE_TOKENS = 8
+# torch.compile del forward (solo CUDA). No se usa cache KV estático: el cache de prefijos,
+# el de sesiones y el scheduler trabajan sobre DynamicCache.
+TORCH_COMPILE_MODEL = False
+
+# Decodificación especulativa (solo backend transformers, de a una petición):
+# None, "prompt_lookup" (n-gramas copiados del prompt: las respuestas citan mucho la evidencia)
+# o "draft" (modelo borrador pequeño con el mismo tokenizador que MODEL_ID)
+SPECULATIVE_MODE = None
+PROMPT_LOOKUP_TOKENS = 10
+DRAFT_MODEL_ID = None
+
+# Snapshot de los pesos ya cuantizados a NF4 (safetensors, se mapean con mmap al cargar).
+# Se exporta una vez tras la primera carga en GPU; los arranques siguientes no re-cuantizan.
+MODEL_SNAPSHOT_DIR = "data/model_snapshot"
+SAVE_MODEL_SNAPSHOT = True
+
+STREAM_TIMEOUT_S = 300
+# Las peticiones concurrentes comparten un mismo forward pass (batching continuo)
+USE_BATCH_SCHEDULER = True
+# KV-cache del turno anterior de cada conversación (LRU acotado en memoria). En GPU el
+# presupuesto es una fracción de la memoria del dispositivo; en CPU, un tope en MB de RAM.
+# Bajo presión de memoria la MemoryPolicy desaloja la mitad más antigua.
+ENABLE_SESSION_CACHE = True
+SESSION_CACHE_GPU_FRACTION = 0.05
+SESSION_CACHE_CPU_BUDGET_MB = 512
+
+
+class _CancelCriteria(StoppingCriteria):
+    """
+    Detiene model.generate cuando el cliente del stream se desconecta.
+    """
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class _FirstTokenTimer(BaseStreamer):
+    """
+    Marca el instante del primer token generado (fin del prefill) dentro de model.generate.
+    generate llama a put() primero con el prompt y luego con cada token nuevo.
+    Reenvía todo a `inner` (el streamer de texto) si lo hay.
+    """
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.calls = 0
+        self.first_token_at = None
+
+    def put(self, value):
+        self.calls += 1
+        if self.calls == 2:
+            self.first_token_at = time.perf_counter()
+        if self.inner is not None:
+            self.inner.put(value)
+
+    def end(self):
+        if self.inner is not None:
+            self.inner.end()
+
+
+class LLMEngine:
+    """
+    Clase para manejar el modelo de lenguaje LLM.
+    Carga el modelo y el tokenizador, y proporciona un método para generar texto.
+    """
+    def __init__(self):
+        """
+         Inicializa el modelo y el tokenizador (en paralelo: el tokenizador no espera a los pesos).
+        """
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        print(f":) Titi Cargando en {self.device}...")
+
+        compute_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float16
+        
+        # El snapshot guarda su configuración de cuantización en config.json
+        snapshot = self.device == "cuda" and snapshot_is_valid(MODEL_SNAPSHOT_DIR, MODEL_ID)
+        source = MODEL_SNAPSHOT_DIR if snapshot else MODEL_ID
+        if snapshot:
+            print(f":) Cargando pesos NF4 pre-cuantizados desde {MODEL_SNAPSHOT_DIR}")
+            model_kwargs = {}
+        elif self.device == "cuda":
+            bnb_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=compute_dtype,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                )
+            model_kwargs = {"quantization_config": bnb_config}
+        else:
+            # bitsandbytes 4-bit necesita CUDA; en CPU sin GGUF queda fp32 (lento)
+            print(":/ Sin GPU ni modelo GGUF: cargando en fp32, la generación será lenta.")
+            model_kwargs = {"torch_dtype": torch.float32}
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="titi-load") as pool:
+            tokenizer_future = pool.submit(AutoTokenizer.from_pretrained, source)
+            model_future = pool.submit(
+                AutoModelForCausalLM.from_pretrained,
+                source, 
+                device_map=self.device,
+                attn_implementation="sdpa",
+                **model_kwargs
+            )
+            draft_future = None
+            if SPECULATIVE_MODE == "draft" and DRAFT_MODEL_ID:
+                draft_future = pool.submit(
+                    AutoModelForCausalLM.from_pretrained,
+                    DRAFT_MODEL_ID, torch_dtype=compute_dtype if self.device == "cuda" else torch.float32,
+                    device_map=self.device,
+                )
+            self.tokenizer = tokenizer_future.result()
+            self.model = model_future.result()
+            draft_model = draft_future.result() if draft_future else None
+        if self.device == "cuda" and not snapshot and SAVE_MODEL_SNAPSHOT:
+            # En segundo plano: los pesos solo se leen, se puede generar mientras tanto
+            threading.Thread(
+                target=save_snapshot, args=(self.tokenizer, self.model, MODEL_SNAPSHOT_DIR, MODEL_ID),
+                name="titi-snapshot", daemon=True,
+            ).start()
+        if TORCH_COMPILE_MODEL and self.device == "cuda":
+            # dynamic=True: una sola compilación para todos los largos de secuencia
+            self.model.forward = torch.compile(self.model.forward, dynamic=True)
+            print(":) Forward del modelo compilado con torch.compile (se termina de compilar en el calentamiento).")
+        self._init_runtime(speculative=SPECULATIVE_MODE, draft_model=draft_model)
+
+    @classmethod
+    def from_components(cls, tokenizer, model, use_scheduler=USE_BATCH_SCHEDULER, speculative=None, draft_model=None):
+        """
+        Construye el motor con un tokenizador y un modelo ya cargados (benchmarks, modelos locales).
+        """
+        engine = cls.__new__(cls)
+        engine.device = str(model.device)
+        engine.tokenizer = tokenizer
+        engine.model = model
+        engine._init_runtime(use_scheduler, speculative, draft_model)
+        return engine
+
+    def _init_runtime(self, use_scheduler=USE_BATCH_SCHEDULER, speculative=None, draft_model=None):
+        """
+        Estado de ejecución: sin scheduler, un lock serializa las llamadas directas a model.generate.
+        """
+        self._generate_lock = threading.Lock()
+        # Limpieza de memoria por presión/inactividad (no en cada llamada)
+        self.memory = MemoryPolicy()
+        self.speculative = speculative if speculative != "draft" or draft_model is not None else None
+        self.draft_model = draft_model
+        # Tokens producidos, pasadas del modelo objetivo y tokens del borrador propuestos/aceptados
+        self.spec_stats = {"requests": 0, "new_tokens": 0, "forward_passes": 0,
+                           "proposed_draft_tokens": 0, "accepted_draft_tokens": 0}
+        if self.speculative and use_scheduler:
+            # La generación asistida de transformers solo admite lotes de 1
+            print(f":/ Decodificación especulativa ({self.speculative}): se desactiva el scheduler por lotes.")
+            use_scheduler = False
+        # Prefijos constantes ya prellenados: [(texto, token_ids, past_key_values)]
+        self.prefix_cache = []
+        self.session_cache = SessionCache(self._session_budget_bytes()) if ENABLE_SESSION_CACHE else None
+        if self.session_cache is not None:
+            self.memory.register_evictor(self.session_cache.evict)
+        self.scheduler = BatchScheduler(self) if use_scheduler else None
+
+    def _session_budget_bytes(self):
+        device = self.model.device
+        if device.type == "cuda":
+            return int(torch.cuda.get_device_properties(device).total_memory * SESSION_CACHE_GPU_FRACTION)
+        return SESSION_CACHE_CPU_BUDGET_MB * 1024 * 1024
+
+    def register_prefix(self, text):
+        """
+        Precalcula el KV-cache de un prefijo fijo (instrucciones del sistema).
+        Los prompts que empiecen por este texto solo prellenan la parte variable.
+        """
+        if any(cached_text == text for cached_text, _, _ in self.prefix_cache):
+            return
+        ids = self.tokenizer(text)["input_ids"]
+        with self._generate_lock, torch.no_grad():
+            input_ids = torch.tensor([ids], device=self.model.device)
+            out = self.model(input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True, logits_to_keep=1)
+        self.prefix_cache.append((text, ids, out.past_key_values))
+        print(f":) Prefijo fijo precalculado ({len(ids)} tokens).")
+
+    def _encode(self, prompt):
+        """
+        Tokeniza el prompt. Si empieza por un prefijo registrado, el prefijo se tokeniza
+        por separado para que sus ids coincidan exactamente con los del KV-cache guardado.
+        """
+        for text, ids, _ in self.prefix_cache:
+            if prompt.startswith(text):
+                rest = self.tokenizer(prompt[len(text):], add_special_tokens=False)["input_ids"]
+                return ids + rest
+        return self.tokenizer(prompt)["input_ids"]
+
+    def _lookup_prefix(self, ids, session_id=None):
+        """
+        Retorna (n_tokens_en_cache, copia_del_cache) para el prefijo más largo que
+        coincide con `ids`, o (0, None). Considera los prefijos fijos y el estado del
+        turno anterior de la conversación. Siempre deja al menos un token por prellenar.
+        """
+        best = (0, None)
+        for _, cached_ids, cache in self.prefix_cache:
+            n = len(cached_ids)
+            if best[0] < n < len(ids) and ids[:n] == cached_ids:
+                best = (n, cache)
+
+        session = self.session_cache.get(session_id) if self.session_cache and session_id else None
+        if session is not None:
+            session_ids, session_kv = session
+            n = min(common_prefix_len(ids, session_ids), len(ids) - 1)
+            if n > best[0]:
+                return n, slice_cache(session_kv, n)
+
+        if best[1] is None:
+            return 0, None
+        return best[0], copy.deepcopy(best[1])
+
+    def _store_session(self, session_id, ids, cache):
+        """
+        Guarda el estado final de un turno (prompt + respuesta) para la siguiente petición.
+        """
+        if self.session_cache is None or not session_id:
+            return
+        self.session_cache.put(session_id, ids, cache)
+
+    def _prefill_begin(self, ids, session_id=None):
+        """
+        Punto de partida del prefill de `ids`: el KV-cache de prefijos o de la sesión cuando
+        es posible. Retorna (past_key_values, tokens que ya estaban en cache).
+        """
+        n_cached, cache = self._lookup_prefix(ids, session_id)
+        if cache is None:
+            cache = DynamicCache()
+        return cache, n_cached
+
+    def _prefill_chunk(self, cache, ids):
+        """
+        Prellena un tramo de tokens a continuación de `cache` (el scheduler parte los prompts
+        largos en tramos). Retorna (past_key_values, logits del último token).
+        """
+        input_ids = torch.tensor([ids], device=self.model.device)
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids, past_key_values=cache, use_cache=True, logits_to_keep=1)
+        return out.past_key_values, out.logits[0, -1]
+
+    def _model_inputs(self, prompt, session_id=None):
+        """
+        Entradas para model.generate; incluye una copia del cache reutilizable si aplica.
+        Retorna (inputs, tokens del prompt que ya estaban en cache).
+        """
+        ids = self._encode(prompt)
+        inputs = {
+            "input_ids": torch.tensor([ids], device=self.model.device),
+            "attention_mask": torch.ones((1, len(ids)), dtype=torch.long, device=self.model.device),
+        }
+        n_cached, cache = self._lookup_prefix(ids, session_id)
+        if cache is not None:
+            inputs["past_key_values"] = cache
+        return inputs, n_cached
+
+    def count_tokens(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _generation_kwargs(self, max_tokens):
+        """
+        Parámetros de muestreo compartidos por la generación normal y la de streaming.
+        """
+        kwargs = dict(
+            max_new_tokens=max_tokens,
+            temperature=0.4,
+            do_sample=True,
+            repetition_penalty=1.2,
+            pad_token_id=self.tokenizer.eos_token_id,
+        )
+        if self.speculative == "prompt_lookup":
+            kwargs["prompt_lookup_num_tokens"] = PROMPT_LOOKUP_TOKENS
+        elif self.speculative == "draft":
+            kwargs["assistant_model"] = self.draft_model
+        return kwargs
+
+    def _count_speculation(self):
+        """
+        Mientras esté activo, cuenta las pasadas forward del modelo objetivo y los tokens que
+        el generador de candidatos propuso y que el modelo aceptó (transformers reporta los
+        aceptados de cada pasada en update_candidate_strategy). Retorna (conteos, quitar).
+        """
+        counts = {"forward_passes": 0, "proposed_draft_tokens": 0, "accepted_draft_tokens": 0}
+
+        def _hook(module, args, kwargs):
+            counts["forward_passes"] += 1
+        handle = self.model.register_forward_pre_hook(_hook, with_kwargs=True)
+
+        original = self.model._get_candidate_generator
+        def _get_candidate_generator(*args, **kwargs):
+            generator = original(*args, **kwargs)
+            get_candidates, update = generator.get_candidates, generator.update_candidate_strategy
+
+            def _get_candidates(input_ids, *a, **k):
+                candidates, logits = get_candidates(input_ids, *a, **k)
+                counts["proposed_draft_tokens"] += candidates.shape[1] - input_ids.shape[1]
+                return candidates, logits
+
+            def _update(input_ids, scores, num_matches):
+                counts["accepted_draft_tokens"] += int(num_matches)
+                return update(input_ids, scores, num_matches)
+
+            generator.get_candidates, generator.update_candidate_strategy = _get_candidates, _update
+            return generator
+        # Atributo de instancia: tapa el método de la clase solo durante esta generación
+        self.model._get_candidate_generator = _get_candidate_generator
+
+        def _remove():
+            handle.remove()
+            del self.model._get_candidate_generator
+        return counts, _remove
+
+    def _record_speculation(self, new_tokens, counts):
+        stats = self.spec_stats
+        stats["requests"] += 1
+        stats["new_tokens"] += new_tokens
+        for key in ("forward_passes", "proposed_draft_tokens", "accepted_draft_tokens"):
+            stats[key] += counts[key]
+        proposed = counts["proposed_draft_tokens"]
+        print(f"  :) Especulación: {new_tokens} tokens en {counts['forward_passes']} pasadas, "
+              f"{counts['accepted_draft_tokens']}/{proposed} tokens del borrador aceptados")
+
+    def speculation_stats(self):
+        """
+        Métricas acumuladas de la decodificación especulativa.
+        acceptance_rate = tokens del borrador aceptados / propuestos.
+        """
+        stats = self.spec_stats
+        passes = stats["forward_passes"]
+        proposed = stats["proposed_draft_tokens"]
+        return {
+            "mode": self.speculative,
+            "requests": stats["requests"],
+            "new_tokens": stats["new_tokens"],
+            "forward_passes": passes,
+            "proposed_draft_tokens": proposed,
+            "accepted_draft_tokens": stats["accepted_draft_tokens"],
+            "acceptance_rate": round(stats["accepted_draft_tokens"] / proposed, 3) if proposed else None,
+            "tokens_per_forward": round(stats["new_tokens"] / passes, 3) if passes else None,
+        }
+
+    def generate(self, prompt, max_tokens=1200, session_id=None, trace=None):
+        """
+        Genera la respuesta completa. Con `session_id` (id de conversación) el estado final
+        se conserva para que el siguiente turno solo prellene los tokens nuevos.
+        `trace` (metrics.RequestTrace) recibe los tiempos de cola, prefill y decodificación.
+        """
+        if self.scheduler is not None:
+            return self.scheduler.generate(prompt, max_tokens, session_id, trace)
+        queued = time.perf_counter()
+        with self._generate_lock, self.memory.busy():
+            record_generation(trace, queue_s=time.perf_counter() - queued)
+            return self._generate_direct(prompt, max_tokens, session_id, trace)
+
+    def _generate_direct(self, prompt, max_tokens, session_id=None, trace=None):
+        inputs, n_cached = self._model_inputs(prompt, session_id)
+        input_len = inputs['input_ids'].shape[1]
+        timer = _FirstTokenTimer()
+        if self.speculative:
+            counts, stop_counting = self._count_speculation()
+        start = time.perf_counter()
+        try:
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    **inputs, streamer=timer, return_dict_in_generate=True, **self._generation_kwargs(max_tokens)
+                )
+        finally:
+            if self.speculative:
+                stop_counting()
+        self._record_timings(trace, timer, start, input_len, n_cached, outputs.sequences.shape[1] - input_len)
+        if self.speculative:
+            self._record_speculation(outputs.sequences.shape[1] - input_len, counts)
+        self._store_generation(session_id, outputs)
+        
+        generated_tokens = outputs.sequences[0][input_len:]
+        full_text = self.tokenizer.decode(generated_tokens, skip_special_tokens=True)
+        """
+        if "<start_of_turn>model" in full_text:
+            return full_text.split("<start_of_turn>model")[-1].strip()
+        return full_text.replace(prompt, "").strip()
+        """
+        # gestion de vram: la limpieza la decide self.memory según la presión
+        del inputs, outputs
+        del generated_tokens
+        return full_text.strip()
+
+    def generate_stream(self, prompt, max_tokens=1200, session_id=None, trace=None):
+        """
+        Igual que generate, pero entrega fragmentos de texto a medida que el modelo produce tokens.
+        model.generate corre en un hilo aparte y alimenta un TextIteratorStreamer.
+        """
+        if self.scheduler is not None:
+            yield from self.scheduler.generate_stream(prompt, max_tokens, session_id, trace)
+            return
+        queued = time.perf_counter()
+        with self._generate_lock, self.memory.busy():
+            record_generation(trace, queue_s=time.perf_counter() - queued)
+            yield from self._generate_stream_direct(prompt, max_tokens, session_id, trace)
+
+    def _record_timings(self, trace, timer, start, input_len, n_cached, new_tokens):
+        end = time.perf_counter()
+        first = timer.first_token_at or end
+        record_generation(trace, prompt_tokens=input_len, cached_tokens=n_cached, prefill_s=first - start,
+                          decode_s=end - first, decode_tokens=new_tokens)
+
+    def _store_generation(self, session_id, outputs):
+        if self.session_cache is None or not session_id:
+            return
+        # El cache cubre todos los tokens salvo el último generado, que nunca pasó por el modelo
+        cache = outputs.past_key_values
+        ids = outputs.sequences[0][:cache.get_seq_length()].tolist()
+        self._store_session(session_id, ids, cache)
+
+    def _generate_stream_direct(self, prompt, max_tokens, session_id=None, trace=None):
+        inputs, n_cached = self._model_inputs(prompt, session_id)
+        input_len = inputs['input_ids'].shape[1]
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TIMEOUT_S
+        )
+        timer = _FirstTokenTimer(streamer)
+        cancel = threading.Event()
+        error = []
+
+        def _run():
+            if self.speculative:
+                counts, stop_counting = self._count_speculation()
+            start = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    outputs = self.model.generate(
+                        **inputs,
+                        streamer=timer,
+                        stopping_criteria=StoppingCriteriaList([_CancelCriteria(cancel)]),
+                        return_dict_in_generate=True,
+                        **self._generation_kwargs(max_tokens),
+                    )
+                self._record_timings(trace, timer, start, input_len, n_cached, outputs.sequences.shape[1] - input_len)
+                if self.speculative:
+                    self._record_speculation(outputs.sequences.shape[1] - input_len, counts)
+                if not cancel.is_set():
+                    self._store_generation(session_id, outputs)
+            except Exception as e:
+                error.append(e)
+                # Desbloquea al consumidor si generate falla antes de terminar
+                streamer.end()
+            finally:
+                if self.speculative:
+                    stop_counting()
+
+        worker = threading.Thread(target=_run, daemon=True)
+        worker.start()
+        finished = False
+        try:
+            for chunk in streamer:
+                if chunk:
+                    yield chunk
+            finished = True
+        finally:
+            if not finished:
+                cancel.set()
+            worker.join()
+            del inputs
+        if error:
+            raise error[0]
+
+    def memory_fractions(self):
+        """
+        (fracción libre de la GPU, fracción ocupada por otros procesos), o None en CPU.
+        Lo que reservó el allocator de este proceso no cuenta como de otros.
+        """
+        if not torch.cuda.is_available():
+            return None
+        free, total = torch.cuda.mem_get_info()
+        others = max(0, total - free - torch.cuda.memory_reserved())
+        return free / total, others / total
+
+    def warm_up(self, prefixes=("",), buckets=WARMUP_BUCKETS, decode_tokens=WARMUP_DECODE_TOKENS):
+        """
+        Corre prompts sintéticos por el camino real (tokenizador, cache de prefijos, scheduler)
+        en cada bucket de largo, para que la primera petición no pague la inicialización
+        perezosa de kernels ni la compilación. Retorna {largo: segundos}.
+        """
+        filler_ids = self.tokenizer("Texto de calentamiento del modelo. " * 16, add_special_tokens=False)["input_ids"]
+        timings = {}
+        for length in buckets:
+            ids = (filler_ids * (length // max(len(filler_ids), 1) + 1))[:length]
+            filler = self.tokenizer.decode(ids)
+            start = time.time()
+            for prefix in prefixes:
+                self.generate(prefix + filler + "<end_of_turn>\n<start_of_turn>model\n", max_tokens=decode_tokens)
+            timings[length] = round(time.time() - start, 3)
+            print(f"  :) Calentamiento {length} tokens: {timings[length]}s")
+        return timings
+
+    def unload_model(self):
+        print(":/ Liberando modelo y limpiando VRAM...")
+        if getattr(self, 'scheduler', None) is not None:
+            self.scheduler.shutdown()
+            self.scheduler = None
+        if hasattr(self, 'model'):
+            del self.model
+        if hasattr(self, 'tokenizer'):
+            del self.tokenizer
+        # KV-caches y borrador también viven en la GPU: sin soltarlos, empty_cache no los devuelve
+        self.prefix_cache = []
+        if self.session_cache is not None:
+            self.session_cache.clear()
+        self.draft_model = None
+        self.memory.release()
+        self.memory.shutdown()
+        print(":) VRAM liberada con éxito.")
+
+def snapshot_is_valid(path, source_id):
+    """
+    El snapshot sirve si está completo y fue exportado del mismo modelo de origen.
+    """
+    try:
+        with open(os.path.join(path, "snapshot.json"), 'r', encoding='utf-8') as f:
+            return json.load(f).get("source") == source_id
+    except (OSError, ValueError):
+        return False
+
+
+def save_snapshot(tokenizer, model, path, source_id):
+    """
+    Exporta tokenizador y pesos (ya cuantizados) en safetensors. Se escribe en un directorio
+    temporal y se renombra al final: un snapshot a medias nunca se usa.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        start = time.time()
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        tokenizer.save_pretrained(tmp_path)
+        with open(os.path.join(tmp_path, "snapshot.json"), 'w', encoding='utf-8') as f:
+            json.dump({"source": source_id, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        print(f"  :) Snapshot del modelo guardado en {path} ({time.time() - start:.1f}s)")
+    except Exception as e:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        print(f"  :/ No se pudo guardar el snapshot del modelo: {e}")
+
+
+def create_llm_engine(backend=INFERENCE_BACKEND):
+    """
+    Crea el motor de inferencia según el backend configurado. Ambos motores exponen
+    generate, generate_stream, count_tokens, register_prefix y unload_model.
+    """
+    if backend == "auto":
+        backend = "gguf" if not torch.cuda.is_available() and os.path.exists(GGUF_MODEL_PATH) else "transformers"
+    if backend == "gguf":
+        return GGUFEngine()
+    return LLMEngine()
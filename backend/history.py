@@ -1,25 +1,329 @@
 import json
 import os
+import re
 import glob
+import time
 import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from blob_store import BlobStore
+
+INDEX_FILENAME = "index.sqlite"
+DEFAULT_PAGE_SIZE = 50
+MESSAGE_PAGE_SIZE = 20
+# Campos pesados de cada mensaje: van al BlobStore y solo se envían si se piden
+DETAIL_FIELDS = ("thought", "sources")
+BLOB_REF_SUFFIX = "_ref"
+# Registros "meta" acumulados en un journal antes de compactarlo
+COMPACT_AFTER_META_RECORDS = 50
+# Conversaciones calientes que se mantienen parseadas en memoria
+CACHE_MAX_CONVERSATIONS = 32
+# Blobs creados o reutilizados hace menos de esto no se borran (su mensaje puede estar
+# anexándose en otra conversación mientras se barre)
+BLOB_SWEEP_GRACE_S = 5
+BLOB_REF_RE = re.compile(r"sha256:[0-9a-f]{64}")
 
 class HistoryManager:
-    def __init__(self, storage_dir="data/conversations"):
+    """
+    Historial de conversaciones.
+    Cada conversación es un journal JSONL de solo-anexar ({id}.jsonl): un registro
+    'header' y luego un registro por mensaje o cambio de metadatos. Añadir un mensaje
+    cuesta O(tamaño del mensaje). Un índice SQLite guarda los metadatos para listar.
+    Las conversaciones recientes se guardan parseadas en un LRU de escritura directa,
+    invalidado por mtime/tamaño del archivo; cada conversación tiene su propio lock.
+    """
+    def __init__(self, storage_dir="data/conversations", blob_store=None):
         if storage_dir is None:
             base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
             self.storage_dir = os.path.join(base_dir, "data", "conversations")
         else:
             self.storage_dir = storage_dir
-            
+
         if not os.path.exists(self.storage_dir):
             os.makedirs(self.storage_dir, exist_ok=True)
 
+        self.index_path = os.path.join(self.storage_dir, INDEX_FILENAME)
+        # thought/sources se guardan fuera del journal, comprimidos y deduplicados
+        self.blob_store = blob_store or BlobStore(os.path.join(os.path.dirname(os.path.abspath(self.storage_dir)), "blobs"))
+        self.cache_size = CACHE_MAX_CONVERSATIONS
+        self._cache = OrderedDict()  # id -> (firma del archivo, datos, registros meta)
+        self._cache_lock = threading.Lock()
+        self._locks = {}
+        self._init_index()
+        self._migrate_legacy_json()
+        # Blobs huérfanos de borrados anteriores (o interrumpidos): se limpian sin bloquear el arranque
+        threading.Thread(target=self.collect_orphan_blobs, daemon=True).start()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.index_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_index(self):
+        """
+        Índice de metadatos (id, título, fechas) para listar sin abrir cada conversación.
+        La primera vez se construye a partir de los archivos existentes.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " id TEXT PRIMARY KEY,"
+                " title TEXT NOT NULL,"
+                " created_at TEXT,"
+                " updated_at TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at DESC)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(conversations)")]
+            if "message_count" not in columns:
+                conn.execute("ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+                conn.execute("DELETE FROM meta WHERE key = 'json_migrated'")
+            migrated = conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if not migrated:
+            self.rebuild_index()
+
+    def _migrate_legacy_json(self):
+        """
+        Convierte los archivos {id}.json del formato anterior en journals {id}.jsonl.
+        """
+        legacy = glob.glob(os.path.join(self.storage_dir, "*.json"))
+        for f in legacy:
+            try:
+                with open(f, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+                data.setdefault("id", os.path.splitext(os.path.basename(f))[0])
+                data.setdefault("messages", [])
+                self._write_snapshot(data["id"], data)
+                self._index_conversation(data)
+                os.remove(f)
+            except Exception as e:
+                print(f":/ No se pudo migrar {f}: {e}")
+        if legacy:
+            print(f":) {len(legacy)} conversaciones migradas al formato journal.")
+
+    def rebuild_index(self):
+        """
+        Reconstruye el índice leyendo todos los archivos de conversación (migración).
+        """
+        rows = []
+        for f in glob.glob(os.path.join(self.storage_dir, "*.jsonl")) + glob.glob(os.path.join(self.storage_dir, "*.json")):
+            try:
+                if f.endswith(".jsonl"):
+                    data = self._replay(f)
+                else:
+                    with open(f, 'r', encoding='utf-8') as file:
+                        data = json.load(file)
+                if not data:
+                    continue
+                rows.append((
+                    data.get("id") or os.path.splitext(os.path.basename(f))[0],
+                    data.get("title", "Sin título"),
+                    data.get("created_at", ""),
+                    data.get("updated_at", ""),
+                    len(data.get("messages", [])),
+                ))
+            except:
+                continue
+        with self._connect() as conn:
+            conn.execute("DELETE FROM conversations")
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversations (id, title, created_at, updated_at, message_count)"
+                " VALUES (?, ?, ?, ?, ?)", rows
+            )
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('json_migrated', ?)", (datetime.now().isoformat(),))
+        if rows:
+            print(f":) Índice de historial construido con {len(rows)} conversaciones.")
+
+    def _index_conversation(self, data):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO conversations (id, title, created_at, updated_at, message_count)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (data["id"], data.get("title", "Sin título"), data.get("created_at", ""),
+                 data.get("updated_at", ""), len(data.get("messages", []))),
+            )
+
     def _get_filepath(self, conversation_id):
         """
-        Obtiene la ruta del archivo para una conversación dada.
+        Obtiene la ruta del journal para una conversación dada.
+        """
+        return os.path.join(self.storage_dir, f"{conversation_id}.jsonl")
+
+    # ---------- Journal ----------
+
+    def _write_snapshot(self, conversation_id, data):
+        """
+        Reescribe el journal completo de forma atómica: archivo temporal + fsync + os.replace.
+        Un fallo a mitad de escritura deja intacta la versión anterior.
         """
-        return os.path.join(self.storage_dir, f"{conversation_id}.json")
+        filepath = self._get_filepath(conversation_id)
+        tmp_path = filepath + ".tmp"
+        # Cabecera: todos los metadatos (título, fechas, resumen...) menos los mensajes
+        header = {k: v for k, v in data.items() if k != "messages" and not k.startswith("_")}
+        header.update(op="header", id=data["id"], title=data.get("title", "Sin título"))
+        messages = [self._externalize(msg) for msg in data.get("messages", [])]
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header, ensure_ascii=False) + "\n")
+            for msg in messages:
+                f.write(json.dumps({"op": "message", "msg": msg}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+        return dict(data, messages=messages)
+
+    def _externalize(self, msg):
+        """
+        Mueve los campos pesados del mensaje al BlobStore, dejando 'thought_ref'/'sources_ref'.
+        """
+        if not any(k in msg for k in DETAIL_FIELDS):
+            return msg
+        stored = {k: v for k, v in msg.items() if k not in DETAIL_FIELDS}
+        for k in DETAIL_FIELDS:
+            if msg.get(k):
+                stored[k + BLOB_REF_SUFFIX] = self.blob_store.put(msg[k])
+        return stored
+
+    def _resolve(self, msg, field):
+        # Mensajes antiguos pueden tener el campo inline
+        if msg.get(field):
+            return msg[field]
+        return self.blob_store.get(msg.get(field + BLOB_REF_SUFFIX)) or ""
+
+    def _append_records(self, conversation_id, records):
+        """
+        Anexa registros al journal con fsync. Si el último registro quedó a medias
+        (caída durante una escritura previa), se descarta antes de anexar.
+        """
+        filepath = self._get_filepath(conversation_id)
+        payload = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode('utf-8')
+        with open(filepath, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    f.seek(0)
+                    content = f.read()
+                    f.truncate(content.rfind(b"\n") + 1)
+            f.seek(0, os.SEEK_END)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _replay(self, filepath):
+        """
+        Reconstruye la conversación aplicando los registros del journal en orden.
+        """
+        data = None
+        meta_records = 0
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Registro truncado por una caída: se ignora
+                    continue
+                op = record.get("op")
+                if op == "header":
+                    data = {"title": "Sin título", "created_at": "", "updated_at": ""}
+                    data.update((k, v) for k, v in record.items() if k != "op")
+                    data["messages"] = []
+                elif data is None:
+                    continue
+                elif op == "message":
+                    data["messages"].append(record["msg"])
+                    data["updated_at"] = record["msg"].get("timestamp", data["updated_at"])
+                elif op == "meta":
+                    meta_records += 1
+                    data.update((k, v) for k, v in record.items() if k != "op")
+        if data is not None:
+            data["_meta_records"] = meta_records
+        return data
+
+    def compact(self, conversation_id):
+        """
+        Reescribe el journal como un snapshot limpio (sin registros meta ni líneas rotas).
+        """
+        with self._lock_for(conversation_id):
+            data, _ = self._load_locked(conversation_id)
+            if data:
+                self._cache_put(conversation_id, self._write_snapshot(conversation_id, data), 0)
+
+    # ---------- Cache ----------
+
+    def _lock_for(self, conversation_id):
+        with self._cache_lock:
+            lock = self._locks.get(conversation_id)
+            if lock is None:
+                lock = self._locks[conversation_id] = threading.RLock()
+            return lock
+
+    def _signature(self, conversation_id):
+        try:
+            st = os.stat(self._get_filepath(conversation_id))
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _cache_put(self, conversation_id, data, meta_records):
+        signature = self._signature(conversation_id)
+        with self._cache_lock:
+            self._cache[conversation_id] = (signature, data, meta_records)
+            self._cache.move_to_end(conversation_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_get(self, conversation_id):
+        """
+        Retorna la entrada cacheada si el archivo no cambió desde que se leyó.
+        """
+        with self._cache_lock:
+            entry = self._cache.get(conversation_id)
+            if entry is None:
+                return None
+            self._cache.move_to_end(conversation_id)
+        if entry[0] != self._signature(conversation_id):
+            # Otro proceso (o una edición manual) tocó el archivo
+            self._cache_discard(conversation_id)
+            return None
+        return entry
+
+    def _cache_discard(self, conversation_id):
+        with self._cache_lock:
+            self._cache.pop(conversation_id, None)
+
+    def _load_locked(self, conversation_id):
+        """
+        Datos internos de la conversación (no copiar hacia afuera) y registros meta de su
+        journal: (data, meta_records), o (None, 0) si no existe. Requiere el lock.
+        El LRU puede desalojar la entrada en cualquier momento: no volver a leer la cache.
+        """
+        entry = self._cache_get(conversation_id)
+        if entry is not None:
+            return entry[1], entry[2]
+        filepath = self._get_filepath(conversation_id)
+        if not os.path.exists(filepath):
+            return None, 0
+        data = self._replay(filepath)
+        if data is None:
+            return None, 0
+        meta_records = data.pop("_meta_records", 0)
+        self._cache_put(conversation_id, data, meta_records)
+        return data, meta_records
+
+    @staticmethod
+    def _copy(data):
+        # Copia superficial: quien la reciba puede modificar la lista sin tocar la cache
+        return dict(data, messages=list(data["messages"]))
+
+    # ---------- API ----------
 
     def create_conversation(self):
         """
@@ -37,62 +341,165 @@ class HistoryManager:
 
     def save_conversation(self, conversation_id, data):
         """
-        Guarda o actualiza una conversación en el almacenamiento.
+        Guarda o actualiza una conversación completa en el almacenamiento (reescritura atómica).
         """
-        filepath = self._get_filepath(conversation_id)
         # Actualizar timestamp
         data["updated_at"] = datetime.now().isoformat()
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with self._lock_for(conversation_id):
+            stored = self._write_snapshot(conversation_id, data)
+            self._cache_put(conversation_id, stored, 0)
+            self._index_conversation(data)
 
     def load_conversation(self, conversation_id):
         """
         Carga una conversación desde el almacenamiento.
         """
-        filepath = self._get_filepath(conversation_id)
-        if not os.path.exists(filepath):
+        with self._lock_for(conversation_id):
+            data, _ = self._load_locked(conversation_id)
+            return self._copy(data) if data else None
+
+    def list_conversations(self, limit=DEFAULT_PAGE_SIZE, offset=0):
+        """
+        Lista una página de conversaciones, de la más a la menos reciente.
+        Solo consulta el índice; no abre los archivos de conversación.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, title, updated_at FROM conversations ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+                (limit if limit is not None else -1, offset),
+            ).fetchall()
+        return [{"id": cid, "title": title, "updated_at": updated_at} for cid, title, updated_at in rows]
+
+    def get_messages(self, conversation_id, limit=MESSAGE_PAGE_SIZE, before=None, include=()):
+        """
+        Página de mensajes terminando justo antes del índice `before` (None = los más recientes).
+        Los campos de DETAIL_FIELDS se omiten salvo que estén en `include`; en su lugar
+        cada mensaje lleva 'has_details'. 'next_before' es el cursor de la página anterior.
+        """
+        data = self.load_conversation(conversation_id)
+        if not data:
             return None
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        messages = data["messages"]
+        end = len(messages) if before is None else max(0, min(before, len(messages)))
+        start = max(0, end - limit)
+
+        page = []
+        for index in range(start, end):
+            msg = messages[index]
+            item = {k: v for k, v in msg.items() if k not in DETAIL_FIELDS and not k.endswith(BLOB_REF_SUFFIX)}
+            for k in DETAIL_FIELDS:
+                if k in include:
+                    item[k] = self._resolve(msg, k)
+            item["index"] = index
+            item["has_details"] = any(msg.get(k) or msg.get(k + BLOB_REF_SUFFIX) for k in DETAIL_FIELDS)
+            page.append(item)
 
-    def list_conversations(self):
+        return {
+            "id": data["id"],
+            "title": data.get("title", "Sin título"),
+            "created_at": data.get("created_at", ""),
+            "updated_at": data.get("updated_at", ""),
+            "total": len(messages),
+            "messages": page,
+            "next_before": start if start > 0 else None,
+        }
+
+    def get_message_details(self, conversation_id, index):
         """
-        Lista todas las conversaciones guardadas.
+        Retorna los campos pesados (thought, sources) de un mensaje, o None si no existe.
         """
-        files = glob.glob(os.path.join(self.storage_dir, "*.json"))
-        conversations = []
-        for f in files:
-            try:
-                with open(f, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-                    conversations.append({
-                        "id": data.get("id"),
-                        "title": data.get("title", "Sin título"),
-                        "updated_at": data.get("updated_at", "")
-                    })
-            except:
-                continue
-        # Ordenar por fecha de actualización descendente
-        return sorted(conversations, key=lambda x: x['updated_at'], reverse=True)
+        data = self.load_conversation(conversation_id)
+        if not data or not 0 <= index < len(data["messages"]):
+            return None
+        msg = data["messages"][index]
+        details = {k: self._resolve(msg, k) for k in DETAIL_FIELDS}
+        details["index"] = index
+        return details
 
     def delete_conversation(self, conversation_id):
         """
-        Elimina una conversación del almacenamiento.
+        Elimina una conversación del almacenamiento, junto con los blobs (thought/sources)
+        que ninguna otra conversación referencia.
         """
         filepath = self._get_filepath(conversation_id)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            return True
-        return False
+        refs = set()
+        with self._lock_for(conversation_id):
+            self._cache_discard(conversation_id)
+            with self._connect() as conn:
+                conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            removed = os.path.exists(filepath)
+            if removed:
+                refs = self._journal_refs(filepath)
+                os.remove(filepath)
+        with self._cache_lock:
+            self._locks.pop(conversation_id, None)
+        if refs:
+            self._delete_unreferenced_blobs(refs)
+        return removed
+
+    def _journal_refs(self, filepath):
+        try:
+            with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+                return set(BLOB_REF_RE.findall(f.read()))
+        except FileNotFoundError:
+            return set()
+
+    def _delete_unreferenced_blobs(self, candidates):
+        """
+        Borra los blobs candidatos que no aparecen en ningún journal restante.
+        """
+        sweep_start = time.time()
+        referenced = set()
+        for f in glob.glob(os.path.join(self.storage_dir, "*.jsonl")):
+            referenced |= self._journal_refs(f)
+        orphans = set(candidates) - referenced
+        if not orphans:
+            return 0
+        return self.blob_store.delete(orphans, unused_since=sweep_start - BLOB_SWEEP_GRACE_S)
+
+    def collect_orphan_blobs(self):
+        """
+        Borra los blobs que ningún journal referencia (p. ej. de conversaciones eliminadas
+        antes de que el borrado limpiara sus blobs).
+        """
+        try:
+            removed = self._delete_unreferenced_blobs(self.blob_store.all_refs())
+        except Exception as e:
+            print(f":/ No se pudieron limpiar los blobs huérfanos: {e}")
+            return 0
+        if removed:
+            print(f":) {removed} blobs huérfanos eliminados del historial.")
+        return removed
+
+    def update_metadata(self, conversation_id, touch=True, **fields):
+        """
+        Cambia metadatos (p. ej. el título o el resumen) anexando un registro 'meta' al journal.
+        Con `touch=False` no cambia updated_at (la conversación no sube en la lista).
+        Compacta el journal cuando acumula demasiados registros de este tipo.
+        """
+        with self._lock_for(conversation_id):
+            data, meta_records = self._load_locked(conversation_id)
+            if data is None:
+                return False
+            if touch:
+                fields["updated_at"] = datetime.now().isoformat()
+            self._append_records(conversation_id, [dict(fields, op="meta")])
+            data.update(fields)
+            self._cache_put(conversation_id, data, meta_records + 1)
+            with self._connect() as conn:
+                for key in ("title", "updated_at"):
+                    if key in fields:
+                        conn.execute(f"UPDATE conversations SET {key} = ? WHERE id = ?", (fields[key], conversation_id))
+            if meta_records + 1 >= COMPACT_AFTER_META_RECORDS:
+                self.compact(conversation_id)
+        return True
 
     def add_message(self, conversation_id, role, content, sources=None, thought=None):
         """
-        Añade un mensaje a una conversación existente.
+        Añade un mensaje a una conversación existente anexándolo al journal.
+        Retorna el mensaje guardado (con thought/sources como referencias a blobs),
+        o None si la conversación no existe.
         """
-        data = self.load_conversation(conversation_id)
-        if not data:
-            return None
-        
         msg = {
             "role": role,
             "content": content,
@@ -100,12 +507,31 @@ class HistoryManager:
         }
         if sources: msg["sources"] = sources
         if thought: msg["thought"] = thought
-        
-        data["messages"].append(msg)
-        
-        # Generar título basado en el primer mensaje de usuario si es "Nueva investigación"
-        if len(data["messages"]) == 1 and role == "user":
-            data["title"] = content[:40] + "..."
-            
-        self.save_conversation(conversation_id, data)
-        return data
\ No newline at end of file
+        msg = self._externalize(msg)
+
+        with self._lock_for(conversation_id):
+            data, meta_records = self._load_locked(conversation_id)
+            if data is None:
+                return None
+
+            records = [{"op": "message", "msg": msg}]
+            title = None
+            # Generar título basado en el primer mensaje de usuario si es "Nueva investigación"
+            if not data["messages"] and role == "user":
+                title = content[:40] + "..."
+                records.append({"op": "meta", "title": title})
+                meta_records += 1
+            self._append_records(conversation_id, records)
+
+            data["messages"].append(msg)
+            data["updated_at"] = msg["timestamp"]
+            if title:
+                data["title"] = title
+            self._cache_put(conversation_id, data, meta_records)
+
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE conversations SET updated_at = ?, message_count = ?, title = COALESCE(?, title) WHERE id = ?",
+                    (msg["timestamp"], len(data["messages"]), title, conversation_id),
+                )
+        return msg
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+EMBEDDING_DIM = 384  # all-MiniLM-L6-v2
+# search() recorre la matriz completa en cada petición: pasado este tope se descartan
+# las filas más antiguas hasta quedar en EVICT_TO_FRACTION del tope
+MAX_INDEX_ROWS = 50000
+EVICT_TO_FRACTION = 0.9
+
+
+class SemanticIndex:
+    """
+    Índice vectorial local de la evidencia ya vista (snippets de búsqueda y respuestas).
+    Los embeddings se guardan como una matriz float32 en disco que se lee con np.memmap;
+    los metadatos van en un JSONL con una línea por fila de la matriz.
+    Las filas borradas quedan como lápidas (search() las salta) hasta que compact()
+    reescribe ambos archivos sin ellas.
+    """
+    def __init__(self, embedder_fn, index_dir="data/semantic_index", dim=EMBEDDING_DIM):
+        self.embedder_fn = embedder_fn
+        self.dim = dim
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.meta_path = os.path.join(index_dir, "meta.jsonl")
+        # Claves borradas aún no compactadas (sobreviven a un reinicio)
+        self.tombstones_path = os.path.join(index_dir, "tombstones.txt")
+        self._lock = threading.Lock()
+        self._compacting = False
+        os.makedirs(index_dir, exist_ok=True)
+        self._finish_interrupted_compaction()
+
+        self.meta = []
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.meta = [json.loads(line) for line in f if line.strip()]
+        # Si el proceso murió entre las dos escrituras, nos quedamos con las filas completas
+        rows_on_disk = os.path.getsize(self.vectors_path) // (4 * dim) if os.path.exists(self.vectors_path) else 0
+        self.meta = self.meta[:rows_on_disk]
+        if os.path.exists(self.vectors_path):
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(len(self.meta) * 4 * dim)
+        self._keys = {m["key"] for m in self.meta}
+        self._dead = set()
+        self._matrix = None
+
+        if os.path.exists(self.tombstones_path):
+            with open(self.tombstones_path, 'r', encoding='utf-8') as f:
+                buried = {line.strip() for line in f if line.strip()}
+            self._bury([i for i, m in enumerate(self.meta) if m["key"] in buried])
+            self.compact()
+
+    def __len__(self):
+        return len(self.meta) - len(self._dead)
+
+    def _finish_interrupted_compaction(self):
+        """
+        compact() reemplaza primero meta.jsonl y luego vectors.f32. Si el proceso murió entre
+        los dos pasos, el temporal de vectores ya está completo y basta con moverlo.
+        """
+        vectors_tmp, meta_tmp = self.vectors_path + ".tmp", self.meta_path + ".tmp"
+        if os.path.exists(meta_tmp):
+            # Murió antes del primer reemplazo: los archivos originales siguen intactos
+            os.remove(meta_tmp)
+            if os.path.exists(vectors_tmp):
+                os.remove(vectors_tmp)
+        elif os.path.exists(vectors_tmp):
+            os.replace(vectors_tmp, self.vectors_path)
+
+    @staticmethod
+    def _key(item):
+        # Los snippets se identifican por URL; las respuestas, por su texto
+        raw = item.get("href") or ""
+        if not raw or item.get("kind") == "answer":
+            raw += item.get("text", "")
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _embed(self, texts):
+        embedder = self.embedder_fn() if self.embedder_fn else None
+        if embedder is None:
+            return None
+        vectors = embedder.encode(texts, normalize_embeddings=True, convert_to_numpy=True, batch_size=32)
+        return np.asarray(vectors, dtype=np.float32)
+
+    def add(self, items):
+        """
+        items: dicts con 'text' y opcionalmente 'title', 'href', 'kind', 'mode', 'conversation_id'.
+        Ignora los que ya están indexados (misma URL o mismo texto).
+        """
+        with self._lock:
+            fresh, seen = [], set()
+            for item in items:
+                key = self._key(item)
+                if item.get("text") and key not in self._keys and key not in seen:
+                    seen.add(key)
+                    fresh.append(dict(item, key=key))
+        if not fresh:
+            return 0
+        vectors = self._embed([f"{m.get('title', '')}. {m['text']}" for m in fresh])
+        if vectors is None:
+            return 0
+
+        with self._lock:
+            # Otro hilo pudo indexar lo mismo mientras calculábamos los embeddings
+            keep = [i for i, m in enumerate(fresh) if m["key"] not in self._keys]
+            fresh = [fresh[i] for i in keep]
+            vectors = vectors[keep]
+            if not fresh:
+                return 0
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.meta_path, 'a', encoding='utf-8') as f:
+                for m in fresh:
+                    f.write(json.dumps(m, ensure_ascii=False) + "\n")
+            self.meta.extend(fresh)
+            self._keys.update(m["key"] for m in fresh)
+            self._matrix = None
+
+            live = [i for i in range(len(self.meta)) if i not in self._dead]
+            overflow = len(live) - MAX_INDEX_ROWS
+            if overflow > 0:
+                evict = len(live) - int(MAX_INDEX_ROWS * EVICT_TO_FRACTION)
+                self._bury(live[:evict])
+        if overflow > 0:
+            print(f"  :) Índice local sobre el tope: se descartan las {evict} filas más antiguas.")
+            self.compact()
+        return len(fresh)
+
+    def _bury(self, rows):
+        """
+        Marca filas como borradas. Requiere el lock.
+        """
+        self._dead.update(rows)
+        self._keys.difference_update(self.meta[i]["key"] for i in rows)
+
+    def remove(self, conversation_id):
+        """
+        Quita del índice las respuestas guardadas de una conversación (al borrarla).
+        search() deja de verlas de inmediato; los archivos se compactan en segundo plano.
+        """
+        with self._lock:
+            rows = [i for i, m in enumerate(self.meta)
+                    if i not in self._dead and m.get("conversation_id") == conversation_id]
+            if not rows:
+                return 0
+            with open(self.tombstones_path, 'a', encoding='utf-8') as f:
+                for i in rows:
+                    f.write(self.meta[i]["key"] + "\n")
+            self._bury(rows)
+            start = not self._compacting
+            self._compacting = True
+        if start:
+            threading.Thread(target=self._compact_in_background, daemon=True).start()
+        return len(rows)
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"  :/ No se pudo compactar el índice local: {e}")
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def compact(self):
+        """
+        Reescribe vectors.f32 y meta.jsonl sin las filas borradas. Retorna cuántas quitó.
+        """
+        with self._lock:
+            if not self._dead:
+                if os.path.exists(self.tombstones_path):
+                    os.remove(self.tombstones_path)
+                return 0
+            live = [i for i in range(len(self.meta)) if i not in self._dead]
+            matrix = self._get_matrix()
+            vectors = np.array(matrix[live], dtype=np.float32) if live else np.zeros((0, self.dim), np.float32)
+            meta = [self.meta[i] for i in live]
+            # En Windows no se puede reemplazar un archivo mapeado: soltar el memmap antes
+            del matrix
+            self._matrix = None
+
+            vectors_tmp, meta_tmp = self.vectors_path + ".tmp", self.meta_path + ".tmp"
+            with open(vectors_tmp, 'wb') as f:
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(meta_tmp, 'w', encoding='utf-8') as f:
+                for m in meta:
+                    f.write(json.dumps(m, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(meta_tmp, self.meta_path)
+            os.replace(vectors_tmp, self.vectors_path)
+            if os.path.exists(self.tombstones_path):
+                os.remove(self.tombstones_path)
+
+            removed = len(self._dead)
+            self.meta = meta
+            self._dead = set()
+        return removed
+
+    def _get_matrix(self):
+        if self._matrix is None and self.meta:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(len(self.meta), self.dim))
+        return self._matrix
+
+    def search(self, query, k=6, min_score=0.0, mode=None):
+        """
+        Retorna [(score, metadatos)] ordenados por similitud coseno descendente.
+        """
+        if not self.meta:
+            return []
+        query_vec = self._embed([query])
+        if query_vec is None:
+            return []
+        with self._lock:
+            matrix = self._get_matrix()
+            if matrix is None:
+                return []
+            meta = self.meta[:matrix.shape[0]]
+            dead = set(self._dead)
+            scores = np.asarray(matrix @ query_vec[0])
+            # Sin referencias al memmap fuera del lock: compact() tiene que poder soltarlo
+            del matrix
+        order = np.argsort(-scores)
+        hits = []
+        for i in order:
+            score = float(scores[i])
+            if score < min_score:
+                break
+            if i in dead:
+                continue
+            if mode is not None and meta[i].get("mode") != mode:
+                continue
+            hits.append((score, meta[i]))
+            if len(hits) >= k:
+                break
+        return hits
@@ -0,0 +1,138 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+# Fracción de la memoria de la GPU reservada por el allocator a partir de la cual se libera
+MEMORY_HIGH_WATERMARK = 0.85
+# Segundos sin generar antes de devolver la memoria cacheada al driver
+MEMORY_IDLE_CLEANUP_S = 60
+MEMORY_CHECK_INTERVAL_S = 10
+
+
+class MemoryPolicy:
+    """
+    Limpieza de memoria por presión en vez de en cada llamada.
+    - Tras cada generación solo se mira el allocator: si la memoria reservada supera el
+      umbral alto, se llama a los desalojadores registrados (p. ej. el cache de sesiones,
+      que empty_cache no puede liberar mientras siga referenciado) y luego gc + empty_cache;
+      si no, el pool caliente se conserva.
+    - Un hilo de fondo libera la cache del allocator una vez tras un rato sin actividad.
+    - stats() expone el estado del allocator y cuántas limpiezas se hicieron.
+    """
+    def __init__(self, high_watermark=MEMORY_HIGH_WATERMARK, idle_cleanup_s=MEMORY_IDLE_CLEANUP_S,
+                 check_interval_s=MEMORY_CHECK_INTERVAL_S):
+        self.high_watermark = high_watermark
+        self.idle_cleanup_s = idle_cleanup_s
+        self.cuda = torch.cuda.is_available()
+        self.total_bytes = torch.cuda.get_device_properties(0).total_memory if self.cuda else 0
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last_activity = time.monotonic()
+        self._idle_cleaned = True
+        self.counters = {"pressure_cleanups": 0, "idle_cleanups": 0, "forced_cleanups": 0, "evicted_bytes": 0}
+        # Funciones sin argumentos que sueltan memoria de la GPU y retornan los bytes liberados
+        self._evictors = []
+
+        self._stop = threading.Event()
+        self._thread = None
+        if idle_cleanup_s:
+            self._thread = threading.Thread(target=self._idle_loop, args=(check_interval_s,),
+                                            name="titi-memory", daemon=True)
+            self._thread.start()
+
+    @contextmanager
+    def busy(self):
+        """
+        Marca una generación en curso: la limpieza por inactividad no corre mientras tanto.
+        """
+        with self._lock:
+            self._active += 1
+            self._touch()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._touch()
+            self.after_generation()
+
+    def register_evictor(self, evict):
+        """
+        Registra algo que se puede desalojar bajo presión (se llama antes de empty_cache).
+        """
+        self._evictors.append(evict)
+
+    def touch(self):
+        with self._lock:
+            self._touch()
+
+    def _touch(self):
+        self._last_activity = time.monotonic()
+        self._idle_cleaned = False
+
+    def after_generation(self):
+        """
+        Chequeo barato tras cada generación: solo limpia si se superó el umbral.
+        """
+        if self.cuda and torch.cuda.memory_reserved() > self.high_watermark * self.total_bytes:
+            self._cleanup("pressure_cleanups", evict=True)
+
+    def release(self):
+        """
+        Limpieza completa inmediata (al descargar el modelo).
+        """
+        self._cleanup("forced_cleanups")
+        if self.cuda:
+            torch.cuda.ipc_collect()
+
+    def _cleanup(self, reason, evict=False):
+        evicted = 0
+        if evict:
+            for evictor in self._evictors:
+                try:
+                    evicted += evictor() or 0
+                except Exception as e:
+                    print(f"  :/ No se pudo desalojar memoria: {e}")
+        gc.collect()
+        if self.cuda:
+            torch.cuda.empty_cache()
+        with self._lock:
+            self.counters[reason] += 1
+            self.counters["evicted_bytes"] += evicted
+
+    def _idle_loop(self, interval):
+        while not self._stop.wait(interval):
+            with self._lock:
+                idle = (self._active == 0 and not self._idle_cleaned
+                        and time.monotonic() - self._last_activity >= self.idle_cleanup_s)
+                if idle:
+                    self._idle_cleaned = True
+            if idle:
+                self._cleanup("idle_cleanups")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["active_generations"] = self._active
+            stats["idle_seconds"] = round(time.monotonic() - self._last_activity, 1)
+        stats["device"] = "cuda" if self.cuda else "cpu"
+        if self.cuda:
+            allocator = torch.cuda.memory_stats()
+            stats.update(
+                total_bytes=self.total_bytes,
+                allocated_bytes=torch.cuda.memory_allocated(),
+                reserved_bytes=torch.cuda.memory_reserved(),
+                max_allocated_bytes=torch.cuda.max_memory_allocated(),
+                reserved_fraction=round(torch.cuda.memory_reserved() / self.total_bytes, 4),
+                high_watermark=self.high_watermark,
+                alloc_retries=allocator.get("num_alloc_retries", 0),
+                ooms=allocator.get("num_ooms", 0),
+            )
+        return stats
+
+    def shutdown(self):
+        self._stop.set()
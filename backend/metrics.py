@@ -0,0 +1,291 @@
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Límites de los buckets (formato Prometheus: cada bucket cuenta las observaciones <= límite)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320)
+# Trazas completas que se conservan en memoria para /traces
+TRACE_HISTORY = 50
+# Imprimir una línea JSON por petición terminada (sin los eventos, que quedan en /traces)
+PRINT_TRACES = True
+
+_current_trace = ContextVar("titi_trace", default=None)
+
+
+def current_trace():
+    """
+    La traza de la petición en curso, o None fuera de una petición.
+    """
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name):
+    """
+    Cronometra una etapa en la traza en curso (no hace nada si no hay traza).
+    """
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    with trace.stage(name):
+        yield
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.labels = tuple(labels)
+        self._series = {}  # etiquetas -> [conteos por bucket, suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    labels = _format_labels(self.labels + ("le",), key + (_format_value(bound),))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(round(total, 6))}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class RequestTrace:
+    """
+    Traza de una petición: segundos por etapa, valores sueltos (tokens, tokens/s) y eventos
+    (cada intento de búsqueda). Las etapas que corren en otros hilos (búsquedas, scheduler)
+    escriben en la misma traza: se activa con activate() o se pasa explícitamente.
+    """
+    def __init__(self, mode, stream=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.stream = stream
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.stages = {}
+        self.values = {}
+        self.events = []
+        self.status = None
+        self.total_s = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        """
+        Hace de esta la traza en curso. No debe abarcar un `yield` de un generador:
+        el contexto no sobrevive entre pasos si cada paso corre en otro hilo.
+        """
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """
+        Suma tiempo a una etapa (p. ej. las dos escrituras del historial).
+        """
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def set(self, key, value):
+        with self._lock:
+            self.values[key] = value
+
+    def event(self, kind, **fields):
+        with self._lock:
+            self.events.append(dict(fields, kind=kind, at_s=round(time.perf_counter() - self._start, 3)))
+
+    def finish(self, status="ok"):
+        self.status = status
+        self.total_s = time.perf_counter() - self._start
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "mode": self.mode,
+                "stream": self.stream,
+                "started_at": self.started_at,
+                "status": self.status,
+                "total_s": round(self.total_s, 4) if self.total_s is not None else None,
+                "stages_s": {name: round(s, 4) for name, s in self.stages.items()},
+                "values": dict(self.values),
+                "events": list(self.events),
+            }
+
+
+class PipelineMetrics:
+    """
+    Métricas agregadas del pipeline de Titi (texto de exposición de Prometheus en render())
+    y las últimas trazas por petición. Todo va etiquetado por modo (academic/legal).
+    """
+    def __init__(self, trace_history=TRACE_HISTORY):
+        self.requests = Counter("titi_requests_total", "Peticiones terminadas.", ("mode", "status"))
+        self.request_seconds = Histogram(
+            "titi_request_seconds", "Latencia total de la petición.", LATENCY_BUCKETS, ("mode",))
+        self.stage_seconds = Histogram(
+            "titi_stage_seconds", "Tiempo por etapa del pipeline.", LATENCY_BUCKETS, ("mode", "stage"))
+        self.search_attempt_seconds = Histogram(
+            "titi_search_attempt_seconds", "Duración de cada intento de búsqueda en DuckDuckGo.",
+            LATENCY_BUCKETS, ("mode", "outcome"))
+        self.search_retries = Counter(
+            "titi_search_retries_total", "Reintentos de búsqueda tras un fallo de red o bloqueo.", ("mode",))
+        self.search_backoff_seconds = Counter(
+            "titi_search_backoff_seconds_total", "Segundos esperados en backoff entre reintentos.", ("mode",))
+        self.search_cache_hits = Counter(
+            "titi_search_cache_hits_total", "Búsquedas respondidas desde el cache en disco.", ("mode",))
+        self.prompt_tokens = Histogram(
+            "titi_prompt_tokens", "Tokens del prompt final.", TOKEN_BUCKETS, ("mode",))
+        self.decode_tokens = Histogram(
+            "titi_decode_tokens", "Tokens generados en la respuesta.", TOKEN_BUCKETS, ("mode",))
+        self.decode_rate = Histogram(
+            "titi_decode_tokens_per_second", "Velocidad de decodificación de la respuesta.", RATE_BUCKETS, ("mode",))
+        self.model_unloads = Counter(
+            "titi_model_unloads_total", "Descargas del modelo por inactividad o presión de memoria.", ("reason",))
+        self.model_reloads = Counter("titi_model_reloads_total", "Recargas del modelo tras una descarga.")
+        self.model_reload_seconds = Histogram(
+            "titi_model_reload_seconds", "Latencia de recarga del modelo (la paga la petición que la dispara).",
+            LATENCY_BUCKETS)
+        self._all = [
+            self.requests, self.request_seconds, self.stage_seconds, self.search_attempt_seconds,
+            self.search_retries, self.search_backoff_seconds, self.search_cache_hits,
+            self.prompt_tokens, self.decode_tokens, self.decode_rate,
+            self.model_unloads, self.model_reloads, self.model_reload_seconds,
+        ]
+        self.traces = deque(maxlen=trace_history)
+
+    def record(self, trace):
+        """
+        Agrega una traza terminada a las métricas.
+        """
+        mode = trace.mode
+        self.requests.inc(mode=mode, status=trace.status)
+        self.request_seconds.observe(trace.total_s, mode=mode)
+        for name, seconds in trace.stages.items():
+            self.stage_seconds.observe(seconds, mode=mode, stage=name)
+        for event in trace.events:
+            if event["kind"] == "search_attempt":
+                self.search_attempt_seconds.observe(event["seconds"], mode=mode, outcome=event["outcome"])
+            elif event["kind"] == "search_backoff":
+                self.search_retries.inc(mode=mode)
+                self.search_backoff_seconds.inc(event["seconds"], mode=mode)
+            elif event["kind"] == "search_cache_hit":
+                self.search_cache_hits.inc(mode=mode)
+        values = trace.values
+        if "prompt_tokens" in values:
+            self.prompt_tokens.observe(values["prompt_tokens"], mode=mode)
+        if "decode_tokens" in values:
+            self.decode_tokens.observe(values["decode_tokens"], mode=mode)
+        if values.get("decode_tokens_per_s"):
+            self.decode_rate.observe(values["decode_tokens_per_s"], mode=mode)
+
+        summary = trace.to_dict()
+        self.traces.append(summary)
+        if PRINT_TRACES:
+            line = {"id": summary["id"], "mode": mode, "status": summary["status"], "total_s": summary["total_s"],
+                    "stages_s": summary["stages_s"], "values": summary["values"], "events": len(summary["events"])}
+            print(f"  :) Traza: {json.dumps(line, ensure_ascii=False)}")
+
+    def render(self):
+        lines = []
+        for metric in self._all:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def recent_traces(self, limit=TRACE_HISTORY):
+        return list(self.traces)[-limit:][::-1]
+
+
+def record_generation(trace, prompt_tokens=None, cached_tokens=None, queue_s=None, prefill_s=None,
+                      decode_s=None, decode_tokens=None):
+    """
+    Lo que reportan los motores de inferencia sobre una generación (trace puede ser None).
+    tokens/s de decodificación: tokens tras el primero / tiempo desde el primer token.
+    """
+    if trace is None:
+        return
+    if prompt_tokens is not None:
+        trace.set("prompt_tokens", prompt_tokens)
+    if cached_tokens is not None:
+        trace.set("cached_prompt_tokens", cached_tokens)
+    if queue_s is not None:
+        trace.add("queue", queue_s)
+    if prefill_s is not None:
+        trace.add("prefill", prefill_s)
+    if decode_s is not None:
+        trace.add("decode", decode_s)
+    if decode_tokens is not None:
+        trace.set("decode_tokens", decode_tokens)
+        if decode_s and decode_tokens > 1:
+            trace.set("decode_tokens_per_s", round((decode_tokens - 1) / decode_s, 2))
@@ -0,0 +1,128 @@
+import re
+
+MODEL_CONTEXT_TOKENS = 8192  # Gemma-2-2B
+PROMPT_SAFETY_TOKENS = 32  # margen por contar las partes por separado
+MAX_CHARS_PER_TOKEN = 24  # cota generosa para recortar antes de tokenizar
+
+
+SOURCE_HEADER_RE = re.compile(r"\n(?=--- FUENTE)")
+
+
+def split_sources(context_data):
+    """
+    Separa el bloque de evidencia ('--- FUENTE ... ---' por entrada) en items, para
+    que el recorte descarte fuentes completas empezando por las menos relevantes.
+    """
+    return SOURCE_HEADER_RE.split(context_data) if context_data else []
+
+
+class PromptSection:
+    """
+    Una sección variable del prompt. `template` contiene '{content}' y los encabezados fijos.
+    El contenido es `text`, o `items` (p. ej. fuentes o turnos) unidos con `joiner`: al
+    recortar, los items se descartan enteros empezando por `drop_from` ('end' o 'start').
+    `priority`: menor = más importante. `min_tokens`: piso garantizado si cabe.
+    """
+    def __init__(self, name, template, text="", items=None, joiner="\n", priority=0,
+                 min_tokens=0, drop_from="end"):
+        self.name = name
+        self.template = template
+        self.text = text or ""
+        self.items = items
+        self.joiner = joiner
+        self.priority = priority
+        self.min_tokens = min_tokens
+        self.drop_from = drop_from
+
+    def content(self):
+        return self.joiner.join(self.items) if self.items is not None else self.text
+
+
+class PromptBuilder:
+    """
+    Arma el prompt final dentro de un presupuesto de tokens medido con el tokenizador real.
+    El prefijo de sistema y el sufijo nunca se recortan (el prefijo tiene KV-cache propio);
+    el resto del presupuesto se reparte entre las secciones por prioridad.
+    """
+    def __init__(self, count_tokens, context_tokens=MODEL_CONTEXT_TOKENS, safety_tokens=PROMPT_SAFETY_TOKENS):
+        self.count_tokens = count_tokens
+        self.context_tokens = context_tokens
+        self.safety_tokens = safety_tokens
+
+    def build(self, prefix, sections, suffix, reserve_tokens=0):
+        """
+        Retorna el prompt: prefix + secciones (en el orden dado) + suffix.
+        `reserve_tokens`: tokens que se dejan libres para la respuesta.
+        """
+        fixed = self.count_tokens(prefix) + self.count_tokens(suffix)
+        fixed += sum(self.count_tokens(s.template.format(content="")) for s in sections)
+        available = self.context_tokens - reserve_tokens - self.safety_tokens - fixed
+
+        needs = {s.name: self.count_tokens(s.content()) for s in sections}
+        by_priority = sorted(sections, key=lambda s: s.priority)
+
+        # Primero los pisos (por prioridad, mientras alcance), luego el resto por prioridad
+        alloc = {}
+        for s in by_priority:
+            alloc[s.name] = min(s.min_tokens, needs[s.name], max(available, 0))
+            available -= alloc[s.name]
+        for s in by_priority:
+            extra = min(needs[s.name] - alloc[s.name], max(available, 0))
+            alloc[s.name] += extra
+            available -= extra
+
+        parts = [prefix]
+        trimmed = []
+        for s in sections:
+            content = s.content()
+            if alloc[s.name] < needs[s.name]:
+                content = self._fit(s, alloc[s.name])
+                trimmed.append(f"{s.name} {needs[s.name]}->{alloc[s.name]}")
+            parts.append(s.template.format(content=content))
+        parts.append(suffix)
+
+        if trimmed:
+            print(f"  :/ Prompt recortado al presupuesto de tokens: {', '.join(trimmed)}")
+        return "".join(parts)
+
+    def _fit(self, section, max_tokens):
+        if max_tokens <= 0:
+            return ""
+        if section.items is None:
+            return self.truncate(section.text, max_tokens, keep_end=section.drop_from == "start")
+
+        items = list(section.items)
+        if section.drop_from == "start":
+            items.reverse()
+        kept, used = [], 0
+        for item in items:
+            cost = self.count_tokens(item + section.joiner)
+            if used + cost > max_tokens:
+                if not kept:
+                    # Ni el primer item cabe entero: se recorta
+                    kept.append(self.truncate(item, max_tokens, keep_end=section.drop_from == "start"))
+                break
+            kept.append(item)
+            used += cost
+        if section.drop_from == "start":
+            kept.reverse()
+        return section.joiner.join(kept)
+
+    def truncate(self, text, max_tokens, keep_end=False):
+        """
+        El prefijo (o sufijo, con keep_end) más largo de `text` que cabe en max_tokens.
+        """
+        if self.count_tokens(text) <= max_tokens:
+            return text
+        limit = max_tokens * MAX_CHARS_PER_TOKEN
+        text = text[-limit:] if keep_end else text[:limit]
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            piece = text[-mid:] if keep_end else text[:mid]
+            if self.count_tokens(piece) <= max_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        cut = text[-lo:] if keep_end and lo else text[:lo]
+        return ("[...] " + cut) if keep_end else (cut + " [...]")
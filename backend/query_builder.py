@@ -0,0 +1,198 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict, defaultdict
+
+QUERY_CACHE_SIZE = 256
+MAX_QUERY_WORDS = 10
+MAX_PHRASES = 4
+MAX_CANDIDATES = 15
+# Si la instrucción + selección aportan menos palabras clave que esto (seguimientos como
+# "¿y qué dice la Corte sobre eso?"), se completan con frases del historial reciente
+MIN_OWN_QUERY_WORDS = 3
+MAX_HISTORY_PHRASES = 3
+HISTORY_CHARS = 3000
+
+STOPWORDS = set("""
+a al algo algunas algunos ante antes aquel aquella aquellas aquellos aqui aquí asi así aun aún bajo bien cada casi
+como cómo con contra cual cuales cuál cuando cuándo de del desde donde dónde dos el él ella ellas ellos en entre era
+eran es esa esas ese eso esos esta está estaba estado estas este esto estos estoy fue fueron ha han hace hacer hacia
+hasta hay la las le les lo los mas más me mi mis mismo mucho muy nada ni no nos nosotros o otra otras otro otros para
+pero poco por porque pues que qué quien quién se sea según ser si sí sido siempre sin sobre solo sólo son su sus
+también tan tanto te tiene tienen todo todos tu tus un una unas uno unos usted ya yo
+analiza analizar busca buscar dame dime explica explicar expande expandir encuentra encontrar redacta redactar
+resume resumir refuta refutar texto esto ese párrafo parrafo favor ayuda ayúdame necesito quiero puedes podrías
+utilizando usando según sobre acerca artículos articulos recientes
+dice dicen decir continúa continua continuar sigue seguir otro otra más mas ejemplo
+the of and or to in on for with by from as at is are was were be been this that these those it its an a into about
+than then there their which who what when where why how not no can could should would may might also such
+""".split())
+
+# Citas jurídicas que conviene conservar literalmente (Sentencia T-025 de 2004, Ley 100 de 1993, ...)
+LEGAL_CITATION_RE = re.compile(
+    r"\b(?:sentencia\s+)?[TCSU]{1,2}-\d{2,4}(?:\s+de\s+\d{4})?"
+    r"|\b(?:ley|decreto|resoluci[oó]n|acuerdo)\s+\d+(?:\s+de\s+\d{4})?"
+    r"|\bart[ií]culo\s+\d+[a-z]?",
+    re.IGNORECASE,
+)
+WORD_RE = re.compile(r"[\wáéíóúüñÁÉÍÓÚÜÑ-]+", re.UNICODE)
+SPLIT_RE = re.compile(r"[.,;:!?¿¡()\[\]{}\"'“”«»\n\t/|]+")
+
+
+def _candidate_phrases(text):
+    """
+    Frases candidatas estilo RAKE: secuencias de palabras entre stopwords y puntuación.
+    """
+    phrases = []
+    for chunk in SPLIT_RE.split(text.lower()):
+        current = []
+        for word in WORD_RE.findall(chunk):
+            if word in STOPWORDS or len(word) < 3 or word.isdigit():
+                if current:
+                    phrases.append(tuple(current))
+                current = []
+            else:
+                current.append(word)
+        if current:
+            phrases.append(tuple(current))
+    # Frases muy largas suelen ser ruido del texto base
+    return [p for p in phrases if len(p) <= 4]
+
+
+def rake_phrases(text, boost_text=""):
+    """
+    Rankea frases clave con RAKE (grado / frecuencia de cada palabra).
+    Las palabras que aparecen en `boost_text` (la instrucción) pesan el doble.
+    """
+    phrases = _candidate_phrases(text)
+    freq = defaultdict(int)
+    degree = defaultdict(int)
+    for phrase in phrases:
+        for word in phrase:
+            freq[word] += 1
+            degree[word] += len(phrase)
+    boosted = set(WORD_RE.findall(boost_text.lower()))
+
+    scores = {}
+    for phrase in phrases:
+        score = sum(degree[w] / freq[w] * (2.0 if w in boosted else 1.0) for w in phrase)
+        scores[phrase] = max(scores.get(phrase, 0.0), score)
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [" ".join(phrase) for phrase, _ in ranked]
+
+
+def _assemble(phrases, citations=()):
+    """
+    Une citas y frases en una query corta, sin repetir palabras.
+    """
+    words, seen = [], set()
+    for citation in citations:
+        # Las citas van literales: "Ley 100 de 1993" no debe perder su "de"
+        words.extend(citation.split())
+        seen.update(w.lower() for w in citation.split())
+    limit = max(MAX_QUERY_WORDS, len(words))
+    for part in phrases:
+        if len(words) >= limit:
+            break
+        for word in part.split():
+            key = word.lower()
+            if key not in seen:
+                seen.add(key)
+                words.append(word)
+    return " ".join(words[:limit])
+
+
+def _citations(text):
+    citations = []
+    for match in LEGAL_CITATION_RE.findall(text):
+        if match.lower() not in (c.lower() for c in citations):
+            citations.append(match)
+    return citations
+
+
+def _history_key(history_context):
+    """
+    Huella del historial normalizado para la memoización: la misma instrucción corta
+    ("continúa") en otra conversación no debe reutilizar la query.
+    """
+    if not history_context:
+        return ""
+    normalized = " ".join(history_context.lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+class QueryBuilder:
+    """
+    Etapa de construcción de la query de búsqueda.
+    Modos:
+      - 'keywords': extracción RAKE sobre selección + instrucción, sin invocar modelos.
+      - 'embedding': candidatos RAKE re-ordenados por similitud con MiniLM.
+      - 'llm': el modelo generativo escribe la query (camino original, más lento).
+    Si la instrucción es un seguimiento corto, las frases del historial reciente completan
+    la query (con menor prioridad que las propias).
+    Los resultados se memorizan por (selección, instrucción, historial, tipo de búsqueda).
+    """
+    MODES = ("keywords", "embedding", "llm")
+
+    def __init__(self, mode="keywords", llm_query_fn=None, embedder_fn=None, cache_size=QUERY_CACHE_SIZE):
+        if mode not in self.MODES:
+            raise ValueError(f"Modo de query desconocido: {mode}")
+        self.mode = mode
+        self.llm_query_fn = llm_query_fn
+        self.embedder_fn = embedder_fn
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def build(self, selection, instruction, history_context="", search_type="academic"):
+        selection = selection.strip() if selection else ""
+        instruction = instruction.strip() if instruction else ""
+        key = (selection, instruction, _history_key(history_context), search_type, self.mode)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        query = self._build_uncached(selection, instruction, history_context, search_type)
+
+        with self._lock:
+            self._cache[key] = query
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return query
+
+    def _build_uncached(self, selection, instruction, history_context, search_type):
+        if self.mode == "llm" and self.llm_query_fn is not None:
+            return self.llm_query_fn(selection, instruction, history_context, search_type=search_type)
+
+        text = f"{instruction}. {selection}"
+        citations = _citations(text) if search_type != "academic" else []
+
+        phrases = rake_phrases(text, boost_text=instruction)
+        if self.mode == "embedding" and self.embedder_fn is not None and len(phrases) > MAX_PHRASES:
+            phrases = self._rank_by_embedding(text, phrases[:MAX_CANDIDATES])
+        phrases = phrases[:MAX_PHRASES]
+
+        own_words = sum(len(p.split()) for p in phrases) + sum(len(c.split()) for c in citations)
+        if history_context and own_words < MIN_OWN_QUERY_WORDS:
+            # Seguimiento: el tema está en los turnos anteriores (lo más reciente al final)
+            history = history_context[-HISTORY_CHARS:]
+            if search_type != "academic" and not citations:
+                citations = _citations(history)[:2]
+            phrases = phrases + rake_phrases(history, boost_text=instruction)[:MAX_HISTORY_PHRASES]
+
+        query = _assemble(phrases, citations)
+        if not query:
+            return instruction if instruction else "science research paper"
+        print(f"  Query Generada ({self.mode}): {query}", flush=True)
+        return query
+
+    def _rank_by_embedding(self, text, phrases):
+        """
+        Ordena las frases candidatas por similitud coseno con el texto completo.
+        """
+        embedder = self.embedder_fn()
+        vectors = embedder.encode([text] + phrases, normalize_embeddings=True, convert_to_numpy=True)
+        scores = vectors[1:] @ vectors[0]
+        order = scores.argsort()[::-1]
+        return [phrases[i] for i in order]
@@ -0,0 +1,60 @@
+import numpy as np
+
+RERANK_TOP_K = 6
+RERANK_DEDUP_THRESHOLD = 0.92
+RERANK_TOKEN_BUDGET = 1200
+
+
+class SnippetReranker:
+    """
+    Reordena los snippets de búsqueda con el embedder MiniLM antes de armar el prompt:
+    descarta casi-duplicados por similitud coseno y se queda con los más relevantes
+    para la query, dentro de un presupuesto de tokens.
+    """
+    def __init__(self, embedder_fn, top_k=RERANK_TOP_K, dedup_threshold=RERANK_DEDUP_THRESHOLD,
+                 token_budget=RERANK_TOKEN_BUDGET, count_tokens=None):
+        self.embedder_fn = embedder_fn
+        self.top_k = top_k
+        self.dedup_threshold = dedup_threshold
+        self.token_budget = token_budget
+        # Sin tokenizador se estima ~4 caracteres por token
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+
+    def rerank(self, query, results, body_chars=500):
+        """
+        `results`: dicts con 'title', 'body', 'href'. Retorna la sublista elegida, ordenada
+        por relevancia. Si el embedder no está disponible devuelve los resultados tal cual.
+        """
+        if not results:
+            return results
+        embedder = self.embedder_fn() if self.embedder_fn else None
+        if embedder is None:
+            return results[:self.top_k]
+
+        texts = [f"{r.get('title', '')}. {r.get('body', '')[:body_chars]}" for r in results]
+        try:
+            vectors = embedder.encode([query] + texts, normalize_embeddings=True, convert_to_numpy=True, batch_size=32)
+        except Exception as e:
+            print(f"  :/ No se pudo reordenar la evidencia: {e}")
+            return results[:self.top_k]
+
+        query_vec, doc_vecs = vectors[0], vectors[1:]
+        relevance = doc_vecs @ query_vec
+        order = np.argsort(-relevance)
+
+        chosen, used_tokens = [], 0
+        for i in order:
+            if len(chosen) >= self.top_k:
+                break
+            if chosen and float(np.max(doc_vecs[chosen] @ doc_vecs[i])) >= self.dedup_threshold:
+                continue
+            cost = self.count_tokens(texts[i])
+            if chosen and used_tokens + cost > self.token_budget:
+                continue
+            chosen.append(int(i))
+            used_tokens += cost
+
+        dropped = len(results) - len(chosen)
+        if dropped:
+            print(f"  :) Evidencia reordenada: {len(chosen)} de {len(results)} snippets (~{used_tokens} tokens).")
+        return [results[i] for i in chosen]
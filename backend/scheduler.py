@@ -0,0 +1,340 @@
+import queue
+import threading
+import time
+import torch
+from transformers import (
+    DynamicCache, TextIteratorStreamer, LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper, TopKLogitsWarper,
+)
+from metrics import record_generation
+
+MAX_BATCH_SIZE = 4
+# Tokens de prefill por paso mientras hay secuencias decodificando: un prompt largo se
+# prellena por tramos intercalados con los pasos de decodificación en vez de frenarlos todos
+PREFILL_CHUNK_TOKENS = 256
+
+
+class GenerationRequest:
+    """
+    Una petición de generación encolada en el scheduler.
+    Acumula los tokens producidos y, si se pidió, los empuja a un streamer de texto.
+    Con `trace` reporta al terminar la espera en cola, el prefill y la decodificación.
+    """
+    def __init__(self, prompt_ids, max_tokens, streamer=None, session_id=None, trace=None):
+        self.prompt_ids = prompt_ids
+        self.max_tokens = max_tokens
+        self.session_id = session_id
+        self.streamer = streamer
+        self.trace = trace
+        self.submitted_at = time.perf_counter()
+        self.admitted_at = None
+        self.first_token_at = None
+        self.cached_tokens = None
+        # Prefill por tramos: KV-cache parcial y tokens del prompt ya procesados
+        self.prefill_cache = None
+        self.prefilled = 0
+        self.tokens = []
+        self.error = None
+        self.cancelled = False
+        self.finished = threading.Event()
+        # Token muestreado que todavía no ha pasado por el modelo
+        self.next_token = None
+
+    def _finish(self, error=None):
+        self.error = error
+        if self.first_token_at is not None:
+            record_generation(
+                self.trace, prompt_tokens=len(self.prompt_ids), cached_tokens=self.cached_tokens,
+                queue_s=self.admitted_at - self.submitted_at,
+                prefill_s=self.first_token_at - self.admitted_at,
+                decode_s=time.perf_counter() - self.first_token_at, decode_tokens=len(self.tokens),
+            )
+        if self.streamer is not None:
+            self.streamer.end()
+        self.finished.set()
+
+
+class BatchScheduler:
+    """
+    Scheduler de batching continuo sobre un único LLMEngine.
+    Un hilo dedicado es el único que toca el modelo: en cada paso admite peticiones
+    nuevas, prellena hasta `prefill_chunk` tokens de ellas (al completar un prompt, la
+    secuencia se fusiona en el batch con padding a la izquierda), avanza un token para
+    todas las secuencias activas en un solo forward y retira las que terminaron.
+    """
+    def __init__(self, engine, max_batch_size=MAX_BATCH_SIZE, prefill_chunk=PREFILL_CHUNK_TOKENS):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.prefill_chunk = prefill_chunk
+        self.pending = queue.Queue()
+        self.active = []
+        self.prefilling = []
+        self.cache = None
+        self.attention_mask = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="titi-scheduler")
+        self._thread.start()
+
+        # Mismos criterios de parada que model.generate
+        eos = engine.model.generation_config.eos_token_id
+        eos = eos if isinstance(eos, (list, tuple)) else [eos]
+        self.eos_ids = {t for t in eos if t is not None}
+        self.processors = LogitsProcessorList([
+            RepetitionPenaltyLogitsProcessor(1.2),
+            TemperatureLogitsWarper(0.4),
+            TopKLogitsWarper(50),
+        ])
+
+    # ---------- API pública ----------
+
+    def submit(self, prompt, max_tokens, stream=False, session_id=None, trace=None):
+        ids = self.engine._encode(prompt)
+        streamer = None
+        if stream:
+            # Import diferido: engine importa este módulo; el plazo es el mismo de la generación directa
+            from engine import STREAM_TIMEOUT_S
+            streamer = TextIteratorStreamer(
+                self.engine.tokenizer, skip_prompt=False, skip_special_tokens=True, timeout=STREAM_TIMEOUT_S
+            )
+        request = GenerationRequest(ids, max_tokens, streamer, session_id, trace)
+        self.pending.put(request)
+        return request
+
+    def generate(self, prompt, max_tokens=1200, session_id=None, trace=None):
+        request = self.submit(prompt, max_tokens, session_id=session_id, trace=trace)
+        request.finished.wait()
+        if request.error is not None:
+            raise request.error
+        return self.engine.tokenizer.decode(request.tokens, skip_special_tokens=True).strip()
+
+    def generate_stream(self, prompt, max_tokens=1200, session_id=None, trace=None):
+        request = self.submit(prompt, max_tokens, stream=True, session_id=session_id, trace=trace)
+        try:
+            for chunk in request.streamer:
+                if chunk:
+                    yield chunk
+        finally:
+            request.cancelled = True
+        if request.error is not None:
+            raise request.error
+
+    def shutdown(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        for request in self.active + self.prefilling:
+            request._finish(RuntimeError("Scheduler detenido"))
+        while not self.pending.empty():
+            self.pending.get_nowait()._finish(RuntimeError("Scheduler detenido"))
+        self.active, self.prefilling, self.cache, self.attention_mask = [], [], None, None
+
+    # ---------- Bucle de decodificación ----------
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self._admit()
+                if self.active or self.prefilling:
+                    self.engine.memory.touch()
+                if self.prefilling:
+                    self._prefill_step()
+                if self.active:
+                    self._step()
+            except Exception as e:
+                print(f"  [!] Error en el scheduler de generación: {e}")
+                for request in self.active + self.prefilling:
+                    request._finish(e)
+                self.active, self.prefilling, self.cache, self.attention_mask = [], [], None, None
+
+    def _admit(self):
+        while len(self.active) + len(self.prefilling) < self.max_batch_size:
+            try:
+                # Si no hay trabajo esperamos; si hay, solo tomamos lo que ya llegó
+                busy = self.active or self.prefilling
+                request = self.pending.get_nowait() if busy else self.pending.get(timeout=0.5)
+            except queue.Empty:
+                return
+            if request.cancelled:
+                request._finish()
+                continue
+            request.admitted_at = time.perf_counter()
+            try:
+                request.prefill_cache, request.cached_tokens = self.engine._prefill_begin(
+                    request.prompt_ids, request.session_id)
+            except Exception as e:
+                request._finish(e)
+                continue
+            request.prefilled = request.cached_tokens
+            self.prefilling.append(request)
+
+    def _prefill_step(self):
+        """
+        Prellena las peticiones admitidas en orden de llegada. Con secuencias decodificando,
+        como mucho `prefill_chunk` tokens por paso; sin ellas no hay a quién frenar y el
+        prompt se procesa entero.
+        """
+        budget = self.prefill_chunk if self.active else None
+        while self.prefilling and (budget is None or budget > 0):
+            request = self.prefilling[0]
+            if request.cancelled:
+                self.prefilling.pop(0)
+                request._finish()
+                continue
+            ids = request.prompt_ids
+            end = len(ids) if budget is None else min(len(ids), request.prefilled + budget)
+            try:
+                cache, logits = self.engine._prefill_chunk(request.prefill_cache, ids[request.prefilled:end])
+            except Exception as e:
+                self.prefilling.pop(0)
+                request._finish(e)
+                continue
+            if budget is not None:
+                budget -= end - request.prefilled
+            request.prefilled, request.prefill_cache = end, cache
+            if end < len(ids):
+                return
+
+            self.prefilling.pop(0)
+            request.prefill_cache = None
+            request.next_token = self._sample(request, logits)
+            request.first_token_at = time.perf_counter()
+            self._emit(request)
+            if request.next_token is None:
+                request._finish()
+                continue
+            self._merge(request, cache)
+            if budget is None:
+                # Ya hay una secuencia decodificando: el resto del prefill va por tramos
+                budget = self.prefill_chunk
+
+    def _merge(self, request, cache):
+        """
+        Añade la secuencia recién prellenada al batch activo, igualando longitudes
+        con padding a la izquierda tanto en el KV-cache como en la máscara de atención.
+        """
+        device = self.engine.model.device
+        new_layers = cache.to_legacy_cache()
+        new_len = new_layers[0][0].shape[-2]
+        new_mask = torch.ones((1, new_len), dtype=torch.long, device=device)
+
+        if not self.active:
+            self.cache = DynamicCache.from_legacy_cache(new_layers)
+            self.attention_mask = new_mask
+            self.active = [request]
+            return
+
+        old_layers = self.cache.to_legacy_cache()
+        old_len = old_layers[0][0].shape[-2]
+        target = max(old_len, new_len)
+
+        merged = []
+        for (ok, ov), (nk, nv) in zip(old_layers, new_layers):
+            merged.append((
+                torch.cat([_left_pad(ok, target), _left_pad(nk, target)], dim=0),
+                torch.cat([_left_pad(ov, target), _left_pad(nv, target)], dim=0),
+            ))
+        self.cache = DynamicCache.from_legacy_cache(tuple(merged))
+        self.attention_mask = torch.cat([
+            _left_pad_mask(self.attention_mask, target),
+            _left_pad_mask(new_mask, target),
+        ], dim=0)
+        self.active.append(request)
+
+    def _step(self):
+        model = self.engine.model
+        device = model.device
+        input_ids = torch.tensor([[r.next_token] for r in self.active], device=device)
+        # La posición de cada token nuevo es el número de tokens reales que lo preceden
+        position_ids = self.attention_mask.sum(dim=-1, keepdim=True)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, torch.ones((len(self.active), 1), dtype=torch.long, device=device)], dim=-1
+        )
+        with torch.no_grad():
+            out = model(
+                input_ids=input_ids,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.cache,
+                use_cache=True,
+            )
+        self.cache = out.past_key_values
+        logits = out.logits[:, -1]
+        for i, request in enumerate(self.active):
+            request.next_token = self._sample(request, logits[i])
+            self._emit(request)
+        self._retire()
+
+    def _sample(self, request, logits):
+        context = torch.tensor([request.prompt_ids + request.tokens], device=logits.device)
+        scores = self.processors(context, logits.float().unsqueeze(0))
+        probs = torch.softmax(scores, dim=-1)
+        return int(torch.multinomial(probs, num_samples=1)[0, 0])
+
+    def _emit(self, request):
+        """
+        Registra el token recién muestreado y decide si la secuencia terminó.
+        """
+        token = request.next_token
+        if token in self.eos_ids:
+            request.next_token = None
+            return
+        request.tokens.append(token)
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([token]))
+        if len(request.tokens) >= request.max_tokens:
+            request.next_token = None
+
+    def _retire(self):
+        keep = []
+        for i, request in enumerate(self.active):
+            if request.next_token is None or request.cancelled:
+                if not request.cancelled and request.session_id:
+                    self._store_session(i, request)
+                request._finish()
+            else:
+                keep.append(i)
+        if len(keep) == len(self.active):
+            return
+        self.engine.memory.after_generation()
+        if not keep:
+            self.active, self.cache, self.attention_mask = [], None, None
+            return
+
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        mask = self.attention_mask.index_select(0, index)
+        # Recorta las columnas de padding que ya ninguna secuencia usa
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        layers = tuple(
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self.cache.to_legacy_cache()
+        )
+        self.cache = DynamicCache.from_legacy_cache(layers)
+        self.attention_mask = mask[:, start:]
+        self.active = [self.active[i] for i in keep]
+
+
+    def _store_session(self, row, request):
+        """
+        Extrae del batch el KV-cache de una fila (sin padding) y lo guarda en la sesión.
+        """
+        valid = self.attention_mask[row].bool()
+        layers = tuple(
+            (k[row:row + 1][:, :, valid].clone(), v[row:row + 1][:, :, valid].clone())
+            for k, v in self.cache.to_legacy_cache()
+        )
+        ids = (request.prompt_ids + request.tokens)[:int(valid.sum())]
+        self.engine._store_session(request.session_id, ids, DynamicCache.from_legacy_cache(layers))
+
+
+def _left_pad(tensor, length):
+    missing = length - tensor.shape[-2]
+    if missing <= 0:
+        return tensor
+    pad = tensor.new_zeros(tensor.shape[:-2] + (missing, tensor.shape[-1]))
+    return torch.cat([pad, tensor], dim=-2)
+
+
+def _left_pad_mask(mask, length):
+    missing = length - mask.shape[-1]
+    if missing <= 0:
+        return mask
+    return torch.cat([mask.new_zeros((mask.shape[0], missing)), mask], dim=-1)
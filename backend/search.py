@@ -0,0 +1,108 @@
+import asyncio
+import contextvars
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SEARCH_DEADLINE_S = 8.0
+SEARCH_WORKERS = 8
+
+# Instante (perf_counter) en que vence el abanico en curso; llega al backend con el contexto
+_deadline = contextvars.ContextVar("titi_search_deadline", default=None)
+
+
+def search_time_left():
+    """
+    Segundos que le quedan al abanico de búsquedas en curso, o None fuera de uno.
+    Los backends lo usan para no reintentar ni esperar backoff cuando ya nadie los espera.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.perf_counter()
+
+
+class SearchFanout:
+    """
+    Lanza varias búsquedas a la vez con un plazo global, y fusiona los resultados
+    deduplicando por URL. Lo que no llegó a tiempo se descarta.
+
+    `backend(query, filters, max_results)` devuelve una lista de dicts con
+    'title', 'body' y 'href'. Puede ser una función normal (corre en un pool de
+    hilos propio) o una corrutina; así se puede probar contra un backend falso.
+    """
+    def __init__(self, backend, deadline_s=SEARCH_DEADLINE_S, max_workers=SEARCH_WORKERS):
+        self.backend = backend
+        self.deadline_s = deadline_s
+        # Pool propio: asyncio.run no espera a sus hilos al cerrar el loop,
+        # así una búsqueda lenta no retiene la respuesta más allá del plazo.
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="titi-search")
+
+    def search(self, jobs, max_results, interleave=False):
+        """
+        Versión síncrona de search_async, para usar desde los hilos de trabajo.
+        """
+        return asyncio.run(self.search_async(jobs, max_results, interleave))
+
+    async def search_async(self, jobs, max_results, interleave=False):
+        """
+        jobs: lista de (query, filtros). Sin `interleave`, los resultados se toman en el
+        orden de los jobs (el primero tiene prioridad); con `interleave`, se alternan
+        entre jobs para que todas las fuentes queden representadas.
+        """
+        start = time.perf_counter()
+        # Las tareas (y los hilos, vía copy_context) heredan el plazo
+        _deadline.set(start + self.deadline_s)
+        tasks = [asyncio.ensure_future(self._run(query, filters, max_results)) for query, filters in jobs]
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline_s)
+        for task in pending:
+            task.cancel()
+        if pending:
+            print(f"  :/ {len(pending)}/{len(tasks)} búsquedas no llegaron antes de {self.deadline_s}s.")
+
+        per_job = []
+        for task in tasks:
+            if task in done and not task.cancelled() and task.exception() is None:
+                per_job.append(task.result() or [])
+            else:
+                if task in done and not task.cancelled():
+                    print(f"  :/ Búsqueda fallida: {task.exception()}")
+                per_job.append([])
+
+        merged = merge_results(per_job, max_results, interleave)
+        print(f"  :) {len(merged)} resultados de {len(jobs)} búsquedas en {time.perf_counter() - start:.2f}s")
+        return merged
+
+    async def _run(self, query, filters, max_results):
+        if inspect.iscoroutinefunction(self.backend):
+            return await self.backend(query, filters, max_results)
+        loop = asyncio.get_running_loop()
+        # run_in_executor no propaga el contexto: así la traza y el plazo llegan al backend
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, self.backend, query, filters, max_results)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def merge_results(per_job, max_results, interleave=False):
+    """
+    Fusiona listas de resultados deduplicando por URL (o por título si no hay URL).
+    """
+    if interleave:
+        ordered = []
+        for rank in range(max((len(r) for r in per_job), default=0)):
+            ordered.extend(r[rank] for r in per_job if rank < len(r))
+    else:
+        ordered = [item for results in per_job for item in results]
+
+    merged, seen = [], set()
+    for item in ordered:
+        key = (item.get('href') or item.get('title') or "").rstrip('/').lower()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        merged.append(item)
+        if len(merged) >= max_results:
+            break
+    return merged
@@ -0,0 +1,84 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+def normalize_query(query):
+    """
+    Normaliza la query para que variantes triviales compartan entrada.
+    """
+    return re.sub(r"\s+", " ", query.strip().lower())
+
+
+class SearchCache:
+    """
+    Cache en disco (SQLite) de resultados de búsqueda.
+    Clave: query normalizada + filtros + max_results. Con TTL y tope de entradas.
+    """
+    def __init__(self, db_path="data/search_cache.sqlite", ttl_seconds=24 * 3600, max_entries=5000):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        directory = os.path.dirname(self.db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache ("
+                " key TEXT PRIMARY KEY,"
+                " results TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_search_cache_created ON search_cache(created_at)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(query, filters="", max_results=0):
+        return f"{normalize_query(query)}|{filters.strip()}|{max_results}"
+
+    def get(self, query, filters="", max_results=0):
+        """
+        Retorna la lista de resultados cacheada o None si no hay entrada vigente.
+        """
+        key = self.make_key(query, filters, max_results)
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT results, created_at FROM search_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+                return None
+        return json.loads(row[0])
+
+    def put(self, query, filters, max_results, results):
+        key = self.make_key(query, filters, max_results)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, results, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(results, ensure_ascii=False), now),
+            )
+            conn.execute("DELETE FROM search_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            # Tope de tamaño: se descartan primero las entradas más antiguas
+            conn.execute(
+                "DELETE FROM search_cache WHERE key IN ("
+                " SELECT key FROM search_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM search_cache")
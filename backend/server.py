@@ -2,14 +2,14 @@ import sys
 import os
 import uvicorn
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from agent import AgentOrchestrator
 from typing import Optional 
 import asyncio
-import gc
-import torch
+import json
 from contextlib import asynccontextmanager
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -29,13 +29,13 @@ orchestrator = None
 async def lifespan(app: FastAPI):
     global orchestrator
     print("------------------------------------------------")
-    print(":/ INICIANDO MOTOR TITI (Esto puede tardar)...")
+    print(":/ INICIANDO MOTOR TITI (el modelo carga en segundo plano)...")
     try:
+        # Historial y estáticos quedan disponibles de inmediato; el modelo carga aparte
         orchestrator = AgentOrchestrator()
-        orchestrator.get_llm() 
-        print(":) MODELO CARGADO EXITOSAMENTE.")
+        orchestrator.start_loading()
     except Exception as e:
-        print(f"!!! ERROR CARGANDO MODELO: {e}")
+        print(f"!!! ERROR INICIANDO TITI: {e}")
         import traceback
         traceback.print_exc()
     
@@ -44,9 +44,6 @@ async def lifespan(app: FastAPI):
     print("Apagando Titi...")
     if orchestrator:
         orchestrator.cleanup()
-    gc.collect()
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -59,8 +56,34 @@ if os.path.exists(STATIC_DIR):
 
 @app.get("/health")
 def health_check():
-    status = "Titi Loaded" if orchestrator else "Loading/Error"
-    return {"status": "ok", "agent": status}
+    # 200 solo con el modelo cargado y caliente: launcher.py espera un 200 para marcarlo listo
+    if not orchestrator or not orchestrator.ready:
+        content = {"status": "loading", "agent": "Loading/Error"}
+        if orchestrator:
+            content.update(orchestrator.load_status())
+        return JSONResponse(status_code=503, content=content)
+    return {"status": "ok", "agent": "Titi Loaded", "warmup": orchestrator.warmup_timings}
+
+@app.get("/stats")
+def stats():
+    if not orchestrator: raise HTTPException(status_code=503)
+    return orchestrator.get_stats()
+
+@app.get("/metrics")
+def metrics():
+    """
+    Métricas en formato de texto de Prometheus (latencia por etapa y modo, búsquedas, tokens).
+    """
+    if not orchestrator: raise HTTPException(status_code=503)
+    return PlainTextResponse(orchestrator.get_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/traces")
+def traces(limit: int = 20):
+    """
+    Trazas de las últimas peticiones, la más reciente primero.
+    """
+    if not orchestrator: raise HTTPException(status_code=503)
+    return orchestrator.get_traces(limit=max(1, limit))
 
 class TitiRequest(BaseModel):
     selection: str
@@ -71,7 +94,7 @@ class TitiRequest(BaseModel):
 @app.post("/titi")
 async def titi_endpoint(data: TitiRequest):
     global orchestrator
-    if not orchestrator:
+    if not orchestrator or not orchestrator.ready:
         raise HTTPException(status_code=503, detail="El modelo aún se está cargando o falló.")
     try:
         result = await asyncio.to_thread(
@@ -86,19 +109,56 @@ async def titi_endpoint(data: TitiRequest):
         print(f"Error en endpoint: {e}")
         return {"answer": f"Error interno: {str(e)}", "sources": "", "thought": ""}
 
+@app.post("/titi/stream")
+def titi_stream_endpoint(data: TitiRequest):
+    """
+    Igual que /titi pero responde en NDJSON: un evento JSON por línea
+    (meta, query, sources, token..., done) a medida que se generan.
+    """
+    if not orchestrator or not orchestrator.ready:
+        raise HTTPException(status_code=503, detail="El modelo aún se está cargando o falló.")
+
+    def event_stream():
+        try:
+            for event in orchestrator.process_titi_task_stream(
+                data.selection,
+                data.instruction,
+                conversation_id=data.conversation_id,
+                mode=data.mode
+            ):
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        except Exception as e:
+            print(f"Error en endpoint (stream): {e}")
+            yield json.dumps({"type": "error", "message": f"Error interno: {str(e)}"}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
 @app.get("/conversations")
-def list_conversations():
+def list_conversations(limit: int = 50, offset: int = 0):
     if not orchestrator: return []
-    return orchestrator.get_history_list()
+    return orchestrator.get_history_list(limit=limit, offset=offset)
 
 @app.get("/conversations/{cid}")
-def get_conversation(cid: str):
+def get_conversation(cid: str, limit: int = 20, before: Optional[int] = None, include: str = ""):
+    """
+    Página de mensajes (los más recientes primero en llegar; `before` es el cursor).
+    `include=thought,sources` agrega los campos pesados, omitidos por defecto.
+    """
     if not orchestrator: raise HTTPException(status_code=503)
-    data = orchestrator.get_conversation_details(cid)
+    fields = tuple(f.strip() for f in include.split(",") if f.strip())
+    data = orchestrator.get_conversation_page(cid, limit=max(1, limit), before=before, include=fields)
     if not data:
         raise HTTPException(status_code=404, detail="Conversación no encontrada")
     return data
 
+@app.get("/conversations/{cid}/messages/{index}/details")
+def get_message_details(cid: str, index: int):
+    if not orchestrator: raise HTTPException(status_code=503)
+    details = orchestrator.get_message_details(cid, index)
+    if details is None:
+        raise HTTPException(status_code=404, detail="Mensaje no encontrado")
+    return details
+
 @app.delete("/conversations/{cid}")
 def delete_conversation(cid: str):
     if not orchestrator: raise HTTPException(status_code=503)
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from transformers import DynamicCache
+
+
+def cache_nbytes(cache):
+    """
+    Bytes ocupados por los tensores de un KV-cache.
+    """
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in cache.to_legacy_cache())
+
+
+def slice_cache(cache, length):
+    """
+    Copia de los primeros `length` tokens de un KV-cache (el original no se modifica).
+    """
+    layers = tuple((k[..., :length, :].clone(), v[..., :length, :].clone()) for k, v in cache.to_legacy_cache())
+    return DynamicCache.from_legacy_cache(layers)
+
+
+def common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class SessionCache:
+    """
+    KV-cache del último turno de cada conversación, indexado por conversation_id.
+    LRU acotado por un presupuesto de memoria en bytes.
+    """
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """
+        Retorna (token_ids, past_key_values) o None. El cache devuelto es compartido: no mutarlo.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(session_id)
+            return entry[0], entry[1]
+
+    def put(self, session_id, ids, cache):
+        size = cache_nbytes(cache)
+        with self._lock:
+            self._drop(session_id)
+            if size > self.budget_bytes:
+                return
+            self._entries[session_id] = (list(ids), cache, size)
+            self.used_bytes += size
+            while self.used_bytes > self.budget_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+
+    def discard(self, session_id):
+        with self._lock:
+            self._drop(session_id)
+
+    def evict(self, fraction=0.5):
+        """
+        Descarta las conversaciones menos recientes hasta liberar al menos `fraction` de lo
+        ocupado. Retorna los bytes liberados.
+        """
+        with self._lock:
+            before = self.used_bytes
+            target = before * (1 - fraction)
+            while self._entries and self.used_bytes > target:
+                self._drop(next(iter(self._entries)))
+            return before - self.used_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self.used_bytes -= entry[2]
@@ -0,0 +1,486 @@
+"""
+Benchmark de punta a punta del pipeline de Titi, offline en CPU y reproducible.
+Usa el corpus grabado de corpus.json (conversaciones de selección + instrucción), una
+búsqueda falsa que sirve resultados enlatados en lugar de DuckDuckGo, el modelo diminuto
+y el embedder por hashing de tiny_model.py. Mide:
+  - latencia p50/p95 de AgentOrchestrator.process_titi_task, y por etapa (trazas de metrics.py)
+  - throughput (peticiones/s y tokens/s) con varias conversaciones concurrentes
+  - el endpoint /titi de FastAPI (TestClient) y el primer token de /titi/stream
+  - E/S del historial: anexar mensajes, carga en frío y en caliente, páginas, listado, compactación
+
+Los datos (historial, índice, cache de búsqueda) van a un directorio temporal.
+Sirve como compuerta de regresión: con --baseline compara contra un JSON guardado con
+--json y termina con código 1 si alguna métrica empeora más que --tolerance.
+
+Uso:
+    python benchmarks/bench_e2e.py
+    python benchmarks/bench_e2e.py --json base.json
+    python benchmarks/bench_e2e.py --baseline base.json --tolerance 0.25
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from tiny_model import HashEmbedder, load_tiny_llm
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_PATH = os.path.join(BENCH_DIR, "corpus.json")
+
+# Métricas donde más alto es mejor; en el resto (latencias, costos) más bajo es mejor
+HIGHER_IS_BETTER = ("_rps", "_tps")
+# La compuerta solo mira medianas y throughput: p95 y media se reportan, pero con pocas
+# muestras son demasiado ruidosos para fallar por ellos
+GATED_SUFFIXES = ("p50_s", "p50_ms", "_rps", "_tps")
+# Diferencias absolutas por debajo de esto son ruido (operaciones de microsegundos, fsync)
+NOISE_FLOOR = {"_ms": 1.0, "_s": 0.01}
+
+
+class CannedSearch:
+    """
+    Backend de búsqueda falso con la firma de SearchFanout: (query, filters, max_results).
+    Devuelve resultados del corpus según el modo (los filtros académicos piden PDFs),
+    rotados de forma determinista por la query, tras `latency_s` de "red".
+    """
+    def __init__(self, results, latency_s=0.0):
+        self.results = results
+        self.latency_s = latency_s
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, query, filters, max_results):
+        with self._lock:
+            self.calls += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        pool = self.results["academic"] if "filetype:pdf" in filters else self.results["legal"]
+        start = zlib.crc32(f"{query} {filters}".encode("utf-8")) % len(pool)
+        return [dict(pool[(start + i) % len(pool)]) for i in range(min(max_results, len(pool)))]
+
+
+def percentile(values, q):
+    """
+    Percentil q (0-100) con interpolación lineal.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def summarize(latencies, unit="s"):
+    scale = 1000 if unit == "ms" else 1
+    return {
+        "n": len(latencies),
+        f"mean_{unit}": round(sum(latencies) / len(latencies) * scale, 4) if latencies else None,
+        f"p50_{unit}": round(percentile(latencies, 50) * scale, 4) if latencies else None,
+        f"p95_{unit}": round(percentile(latencies, 95) * scale, 4) if latencies else None,
+    }
+
+
+@contextlib.contextmanager
+def quiet(enabled):
+    """
+    Silencia los print del pipeline durante las mediciones.
+    """
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def build_orchestrator(args, search):
+    import agent
+    import engine
+    from metrics import PipelineMetrics
+
+    agent.ANSWER_MAX_TOKENS = args.max_tokens
+    agent.ENABLE_HISTORY_SUMMARY = args.summaries
+    # get_llm() importa create_llm_engine al usarse: así recibe el modelo diminuto
+    engine.create_llm_engine = lambda backend=None: load_tiny_llm(use_scheduler=not args.no_scheduler)
+
+    orchestrator = agent.AgentOrchestrator(search_backend=search)
+    orchestrator.embedder = HashEmbedder()
+    orchestrator.metrics = PipelineMetrics(trace_history=100000)
+    orchestrator.get_llm()
+    orchestrator.ready = True
+    return orchestrator
+
+
+def run_conversation(orchestrator, conversation):
+    """
+    Corre los turnos de una conversación en orden. Retorna la latencia de cada turno.
+    """
+    latencies, conversation_id = [], None
+    for turn in conversation["turns"]:
+        start = time.perf_counter()
+        result = orchestrator.process_titi_task(
+            turn["selection"], turn["instruction"], conversation_id=conversation_id, mode=conversation["mode"]
+        )
+        latencies.append(time.perf_counter() - start)
+        conversation_id = result["conversation_id"]
+    return latencies
+
+
+def stage_breakdown(traces):
+    """
+    p50/p95 por etapa (y de los tokens/s de decodificación) a partir de las trazas.
+    """
+    stages = {}
+    for trace in traces:
+        for name, seconds in trace["stages_s"].items():
+            stages.setdefault(name, []).append(seconds)
+    breakdown = {name: summarize(values) for name, values in sorted(stages.items())}
+    rates = [t["values"]["decode_tokens_per_s"] for t in traces if t["values"].get("decode_tokens_per_s")]
+    if rates:
+        breakdown["decode_rate"] = {"p50_tps": round(percentile(rates, 50), 2)}
+    return breakdown
+
+
+def bench_sequential(orchestrator, corpus, repeat):
+    orchestrator.metrics.traces.clear()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for conversation in corpus["conversations"]:
+            latencies.extend(run_conversation(orchestrator, conversation))
+    wall = time.perf_counter() - start
+    result = summarize(latencies)
+    result["throughput_rps"] = round(len(latencies) / wall, 3)
+    result["stages"] = stage_breakdown(list(orchestrator.metrics.traces))
+    return result
+
+
+def bench_stream(orchestrator, corpus):
+    """
+    process_titi_task_stream: tiempo hasta el primer token y hasta el final.
+    """
+    first_token, totals = [], []
+    for conversation in corpus["conversations"]:
+        turn = conversation["turns"][0]
+        start = time.perf_counter()
+        seen_token = False
+        for event in orchestrator.process_titi_task_stream(turn["selection"], turn["instruction"],
+                                                           mode=conversation["mode"]):
+            if event["type"] == "token" and not seen_token:
+                first_token.append(time.perf_counter() - start)
+                seen_token = True
+        totals.append(time.perf_counter() - start)
+    return {"first_token": summarize(first_token), "total": summarize(totals)}
+
+
+def bench_concurrent(orchestrator, corpus, workers, max_tokens):
+    """
+    `workers` hilos recorren el corpus completo, cada uno empezando en otra conversación.
+    """
+    conversations = corpus["conversations"]
+    latencies, lock = [], threading.Lock()
+
+    def _worker(offset):
+        for i in range(len(conversations)):
+            measured = run_conversation(orchestrator, conversations[(offset + i) % len(conversations)])
+            with lock:
+                latencies.extend(measured)
+
+    threads = [threading.Thread(target=_worker, args=(i,)) for i in range(workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    result = summarize(latencies)
+    result["throughput_rps"] = round(len(latencies) / wall, 3)
+    # El modelo diminuto no tiene EOS: cada respuesta son exactamente max_tokens
+    result["throughput_tps"] = round(len(latencies) * max_tokens / wall, 1)
+    return result
+
+
+def bench_http(orchestrator, corpus, workers):
+    import server
+    from fastapi.testclient import TestClient
+
+    server.orchestrator = orchestrator
+    # Sin `with`: no corre el lifespan, que cargaría el modelo real
+    client = TestClient(server.app)
+    turns = [
+        {"selection": c["turns"][0]["selection"], "instruction": c["turns"][0]["instruction"], "mode": c["mode"]}
+        for c in corpus["conversations"]
+    ]
+
+    def _post(payload):
+        start = time.perf_counter()
+        response = client.post("/titi", json=payload)
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    sequential = [_post(payload) for payload in turns]
+
+    # TestClient entrega el cuerpo del stream completo: aquí solo se mide el total
+    stream = []
+    for payload in turns:
+        start = time.perf_counter()
+        response = client.post("/titi/stream", json=payload)
+        response.raise_for_status()
+        stream.append(time.perf_counter() - start)
+
+    concurrent, lock = [], threading.Lock()
+
+    def _worker(offset):
+        for i in range(len(turns)):
+            elapsed = _post(turns[(offset + i) % len(turns)])
+            with lock:
+                concurrent.append(elapsed)
+
+    threads = [threading.Thread(target=_worker, args=(i,)) for i in range(workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    result = {
+        "titi": summarize(sequential),
+        "titi_stream": summarize(stream),
+        f"titi_concurrent_{workers}": summarize(concurrent),
+    }
+    result[f"titi_concurrent_{workers}"]["throughput_rps"] = round(len(concurrent) / wall, 3)
+    return result
+
+
+def bench_history(workdir, corpus, n_messages, n_conversations):
+    """
+    Costos del HistoryManager con mensajes de tamaño realista (fuentes y prompt completo).
+    """
+    from history import HistoryManager
+
+    storage = os.path.join(workdir, "history_bench", "conversations")
+    history = HistoryManager(storage_dir=storage)
+    sources = "\n".join(
+        f"--- FUENTE [{i + 1}] ---\nTÍTULO: {r['title']}\nLINK: {r['href']}\nRESUMEN: {r['body']}...\n"
+        for i, r in enumerate(corpus["search_results"]["academic"])
+    )
+    thought = sources * 2
+
+    cid, _ = history.create_conversation()
+    append = []
+    for i in range(n_messages):
+        start = time.perf_counter()
+        if i % 2 == 0:
+            history.add_message(cid, "user", f"Pregunta de prueba número {i} sobre el tema de la conversación.")
+        else:
+            # Cada respuesta distinta: el BlobStore deduplica textos idénticos
+            history.add_message(cid, "assistant", f"Respuesta {i}. " * 40, sources=f"{i}\n{sources}",
+                                thought=f"{i}\n{thought}")
+        append.append(time.perf_counter() - start)
+
+    def _timed(fn, times=50):
+        samples = []
+        for _ in range(times):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    cold = HistoryManager(storage_dir=storage)
+    cold.cache_size = 0  # cada carga vuelve a leer y reproducir el journal
+    for i in range(n_conversations):
+        other, _ = history.create_conversation()
+        history.add_message(other, "user", f"Conversación de relleno {i}")
+
+    result = {
+        "append": summarize(append, "ms"),
+        "load_warm": summarize(_timed(lambda: history.load_conversation(cid)), "ms"),
+        "load_cold": summarize(_timed(lambda: cold.load_conversation(cid), times=20), "ms"),
+        "page": summarize(_timed(lambda: history.get_messages(cid, limit=20)), "ms"),
+        "details": summarize(_timed(lambda: history.get_message_details(cid, n_messages - 1)), "ms"),
+        "list": summarize(_timed(lambda: history.list_conversations(limit=50)), "ms"),
+        "compact": summarize(_timed(lambda: history.compact(cid), times=5), "ms"),
+    }
+    result["disk_bytes"] = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(os.path.join(workdir, "history_bench")) for name in names
+    )
+    return result
+
+
+def flatten(results, prefix=""):
+    """
+    {"a": {"p50_s": 1}} -> {"a.p50_s": 1}, solo con las métricas numéricas comparables.
+    """
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and key != "n":
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline, tolerance):
+    """
+    Retorna las métricas vigiladas que empeoraron más que `tolerance` (fracción) respecto
+    al baseline y más que el piso de ruido.
+    """
+    regressions = []
+    cur, base = flatten(current["results"]), flatten(baseline["results"])
+    for name, old in sorted(base.items()):
+        new = cur.get(name)
+        if new is None or not old or not name.endswith(GATED_SUFFIXES):
+            continue
+        floor = next((v for suffix, v in NOISE_FLOOR.items() if name.endswith(suffix)), 0)
+        if abs(new - old) <= floor:
+            continue
+        if name.endswith(HIGHER_IS_BETTER):
+            worse = new < old * (1 - tolerance)
+        else:
+            worse = new > old * (1 + tolerance)
+        if worse:
+            regressions.append((name, old, new))
+    return regressions
+
+
+def print_report(results):
+    def _row(name, stats):
+        cells = [f"{name:<28}"]
+        for key in ("p50_s", "p95_s", "p50_ms", "p95_ms", "throughput_rps", "throughput_tps"):
+            if stats.get(key) is not None:
+                cells.append(f"{key}={stats[key]}")
+        print("  ".join(cells))
+
+    print("\n== Pipeline secuencial (process_titi_task)")
+    seq = results["sequential"]
+    _row("total", seq)
+    for stage, stats in seq["stages"].items():
+        if stage == "decode_rate":
+            print(f"{'  decode tokens/s':<28}  p50={stats['p50_tps']}")
+        else:
+            _row(f"  {stage}", stats)
+
+    print("\n== Streaming (process_titi_task_stream)")
+    for name, stats in results["stream"].items():
+        _row(name, stats)
+
+    print("\n== Concurrencia (process_titi_task)")
+    for name, stats in results["concurrent"].items():
+        _row(name, stats)
+
+    if "http" in results:
+        print("\n== FastAPI (TestClient)")
+        for name, stats in results["http"].items():
+            _row(name, stats)
+
+    print("\n== Historial")
+    for name, stats in results["history"].items():
+        if isinstance(stats, dict):
+            _row(name, stats)
+    print(f"{'disco':<28}  {results['history']['disk_bytes'] / 1024:.0f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--max-tokens", type=int, default=16, help="Tokens por respuesta (ANSWER_MAX_TOKENS)")
+    parser.add_argument("--repeat", type=int, default=1, help="Pasadas por el corpus en la fase secuencial")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--search-latency-ms", type=float, default=50, help="Latencia simulada por búsqueda")
+    parser.add_argument("--history-messages", type=int, default=200)
+    parser.add_argument("--history-conversations", type=int, default=100)
+    parser.add_argument("--no-scheduler", action="store_true", help="Generación directa en vez del BatchScheduler")
+    parser.add_argument("--summaries", action="store_true", help="Activa el resumen del historial en segundo plano")
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--json", default=None, help="Guarda los resultados en este archivo")
+    parser.add_argument("--baseline", default=None, help="JSON de una corrida anterior para comparar")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Empeoramiento relativo permitido")
+    parser.add_argument("--verbose", action="store_true", help="Muestra los logs del pipeline")
+    parser.add_argument("--keep-data", action="store_true", help="No borra el directorio temporal de datos")
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(os.path.abspath(args.baseline), encoding="utf-8") as f:
+            baseline = json.load(f)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    workdir = tempfile.mkdtemp(prefix="titi-bench-")
+    cwd = os.getcwd()
+    # Todas las rutas data/... del backend son relativas al directorio de trabajo
+    os.chdir(workdir)
+    try:
+        import metrics
+        metrics.PRINT_TRACES = args.verbose
+        search = CannedSearch(corpus["search_results"], latency_s=args.search_latency_ms / 1000)
+        with quiet(not args.verbose):
+            orchestrator = build_orchestrator(args, search)
+            # Calentamiento (no se mide): primera pasada por los kernels y el prefijo de sistema
+            run_conversation(orchestrator, corpus["conversations"][0])
+
+        results = {}
+        print(f":/ Fase secuencial ({args.repeat} pasada(s) por el corpus)...")
+        with quiet(not args.verbose):
+            results["sequential"] = bench_sequential(orchestrator, corpus, args.repeat)
+            results["stream"] = bench_stream(orchestrator, corpus)
+        results["concurrent"] = {}
+        for workers in args.concurrency:
+            print(f":/ Fase concurrente ({workers} hilos)...")
+            with quiet(not args.verbose):
+                results["concurrent"][f"workers_{workers}"] = bench_concurrent(
+                    orchestrator, corpus, workers, args.max_tokens)
+        if not args.skip_http:
+            print(":/ Fase HTTP...")
+            with quiet(not args.verbose):
+                results["http"] = bench_http(orchestrator, corpus, max(args.concurrency))
+        print(":/ Fase de historial...")
+        with quiet(not args.verbose):
+            results["history"] = bench_history(workdir, corpus, args.history_messages, args.history_conversations)
+            orchestrator.cleanup()
+    finally:
+        os.chdir(cwd)
+        if args.keep_data:
+            print(f":) Datos del benchmark en {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "config": {
+            "max_tokens": args.max_tokens, "repeat": args.repeat, "concurrency": args.concurrency,
+            "search_latency_ms": args.search_latency_ms, "scheduler": not args.no_scheduler,
+            "summaries": args.summaries, "history_messages": args.history_messages,
+            "search_calls": search.calls,
+        },
+        "results": results,
+    }
+    print_report(results)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n:) Resultados guardados en {json_path}")
+
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\n[!] {len(regressions)} métrica(s) empeoraron más de {args.tolerance:.0%}:")
+            for name, old, new in regressions:
+                print(f"  {name}: {old} -> {new}")
+            sys.exit(1)
+        print(f"\n:) Sin regresiones respecto a {args.baseline} (tolerancia {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
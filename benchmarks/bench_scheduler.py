@@ -0,0 +1,83 @@
+"""
+Throughput (tokens/s) frente a concurrencia: generación directa, una petición a la vez,
+contra el BatchScheduler de batching continuo.
+
+Uso:
+    python benchmarks/bench_scheduler.py                   # modelo diminuto, offline en CPU
+    python benchmarks/bench_scheduler.py --model RUTA      # checkpoint local de Hugging Face
+"""
+import argparse
+import threading
+import time
+
+from tiny_model import build_tokenizer, build_model
+
+PROMPTS = [
+    "Resume el principio de proporcionalidad en la jurisprudencia constitucional.",
+    "Explica el efecto de la deforestación sobre la biodiversidad local.",
+    "¿Qué dice la Corte sobre la acción de tutela contra providencias judiciales?",
+    "Compara los métodos de muestreo estratificado y por conglomerados.",
+]
+
+
+def load_components(model_path):
+    if not model_path:
+        tokenizer = build_tokenizer()
+        return tokenizer, build_model(tokenizer)
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path).eval()
+    # Sin EOS todas las peticiones generan exactamente max_tokens
+    model.generation_config.eos_token_id = None
+    return tokenizer, model
+
+
+def run_concurrent(engine, concurrency, max_tokens):
+    """
+    Lanza `concurrency` peticiones simultáneas y devuelve los segundos de pared.
+    """
+    threads = [
+        threading.Thread(target=engine.generate, args=(PROMPTS[i % len(PROMPTS)], max_tokens))
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def main():
+    from engine import LLMEngine
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=None, help="Ruta a un checkpoint local (por defecto, modelo diminuto)")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--max-batch", type=int, default=8)
+    args = parser.parse_args()
+
+    tokenizer, model = load_components(args.model)
+    direct = LLMEngine.from_components(tokenizer, model, use_scheduler=False)
+    batched = LLMEngine.from_components(tokenizer, model, use_scheduler=True)
+    batched.scheduler.max_batch_size = args.max_batch
+
+    # Calentamiento de ambos caminos
+    direct.generate(PROMPTS[0], 4)
+    batched.generate(PROMPTS[0], 4)
+
+    print(f"{'concurrencia':>12} | {'directo tok/s':>14} | {'scheduler tok/s':>16} | {'speedup':>8}")
+    print("-" * 60)
+    for n in args.concurrency:
+        tokens = n * args.max_tokens
+        t_direct = run_concurrent(direct, n, args.max_tokens)
+        t_batched = run_concurrent(batched, n, args.max_tokens)
+        print(f"{n:>12} | {tokens / t_direct:>14.1f} | {tokens / t_batched:>16.1f} | {t_direct / t_batched:>7.2f}x")
+
+    batched.unload_model()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Modelo causal diminuto y tokenizador byte-level construidos en memoria, y un embedder
+por hashing que reemplaza a MiniLM. Permiten correr los benchmarks offline en CPU sin
+descargar Gemma ni sentence-transformers.
+"""
+import os
+import re
+import sys
+import zlib
+
+import numpy as np
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, processors
+from transformers import PreTrainedTokenizerFast, Gemma2Config, Gemma2ForCausalLM
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(os.path.dirname(BENCH_DIR), "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+SPECIAL_TOKENS = ["<pad>", "<eos>", "<bos>"]
+
+
+def build_tokenizer():
+    """
+    Tokenizador de un token por byte (+ especiales), con <bos> al inicio como el de Gemma.
+    """
+    vocab = {tok: i for i, tok in enumerate(SPECIAL_TOKENS)}
+    for ch in sorted(pre_tokenizers.ByteLevel.alphabet()):
+        vocab[ch] = len(vocab)
+    tok = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    tok.post_processor = processors.TemplateProcessing(
+        single="<bos> $A", special_tokens=[("<bos>", vocab["<bos>"])]
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tok,
+        bos_token="<bos>", eos_token="<eos>", pad_token="<pad>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+
+
+def build_model(tokenizer, hidden_size=128, num_layers=4, seed=0):
+    """
+    Gemma2 aleatorio de pocas capas: misma arquitectura (y KV-cache) que el modelo real.
+    """
+    config = Gemma2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        head_dim=hidden_size // 4,
+        max_position_embeddings=8192,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+    )
+    torch.manual_seed(seed)
+    model = Gemma2ForCausalLM(config).eval()
+    # Sin EOS los benchmarks siempre generan max_tokens y son comparables entre corridas
+    model.generation_config.eos_token_id = None
+    return model
+
+
+class HashEmbedder:
+    """
+    Embeddings deterministas de bolsa de palabras (hashing con signo), con la misma
+    interfaz encode() que SentenceTransformer. Textos con palabras en común quedan cerca.
+    """
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, texts, normalize_embeddings=True, convert_to_numpy=True, batch_size=32, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = zlib.crc32(word.encode("utf-8"))
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        if normalize_embeddings:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms == 0, 1.0, norms)
+        return vectors
+
+
+def load_tiny_llm(use_scheduler=False, **model_kwargs):
+    from engine import LLMEngine
+
+    tokenizer = build_tokenizer()
+    model = build_model(tokenizer, **model_kwargs)
+    return LLMEngine.from_components(tokenizer, model, use_scheduler=use_scheduler)
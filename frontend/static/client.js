@@ -2,6 +2,8 @@ let lastSelection = "";
 let currentConversationId = null;
 let currentMode = "academic";
 const SERVER_URL = "https://127.0.0.1:8010"; 
+const HISTORY_PAGE_SIZE = 50;
+const MESSAGE_PAGE_SIZE = 20;
 
 Office.onReady((info) => {
     if (info.host === Office.HostType.Word) {
@@ -309,12 +311,14 @@ function toggleHistoryPanel() {
     if (!isOpen) loadHistoryList();
 }
 
-async function loadHistoryList() {
+async function loadHistoryList(offset = 0) {
     try {
-        const res = await fetch(`${SERVER_URL}/conversations`);
+        const res = await fetch(`${SERVER_URL}/conversations?limit=${HISTORY_PAGE_SIZE}&offset=${offset}`);
         const list = await res.json();
         const container = document.getElementById('history-list');
-        container.innerHTML = "";
+        if (offset === 0) container.innerHTML = "";
+        const oldMore = document.getElementById('history-more');
+        if (oldMore) oldMore.remove();
 
         list.forEach(item => {
             const div = document.createElement('div');
@@ -336,6 +340,16 @@ async function loadHistoryList() {
             div.appendChild(deleteBtn);
             container.appendChild(div);
         });
+
+        // Página llena: puede haber más conversaciones
+        if (list.length === HISTORY_PAGE_SIZE) {
+            const more = document.createElement('button');
+            more.id = 'history-more';
+            more.innerText = "Ver más";
+            more.style.cssText = "width:100%; padding:6px; margin-top:6px; border:none; background:#f4f4f4; cursor:pointer; font-size:11px;";
+            more.onclick = () => loadHistoryList(offset + HISTORY_PAGE_SIZE);
+            container.appendChild(more);
+        }
     } catch(e) { console.error("Error cargando historial", e); }
 }
 
@@ -368,33 +382,82 @@ function setMode(mode) {
 }
 
 
-async function loadConversation(id) {
+async function loadConversation(id, before = null) {
     try {
-        const res = await fetch(`${SERVER_URL}/conversations/${id}`);
+        let url = `${SERVER_URL}/conversations/${id}?limit=${MESSAGE_PAGE_SIZE}`;
+        if (before !== null) url += `&before=${before}`;
+        const res = await fetch(url);
         const data = await res.json();
         currentConversationId = data.id;
         
         const container = document.getElementById("chat-container");
-        container.innerHTML = ""; 
+        const oldMore = document.getElementById("messages-more");
+        if (oldMore) oldMore.remove();
+        if (before === null) container.innerHTML = "";
+        const anchor = container.firstChild;
+        const previousHeight = container.scrollHeight;
         
-        // Reconstruir chat
+        // Reconstruir chat (thought/sources se piden solo al abrir los detalles)
         data.messages.forEach(msg => {
+            let div;
             if (msg.role === 'user') {
-                let display = msg.content;
-                appendMessage("msg-user", display);
+                div = appendMessage("msg-user", msg.content);
             } else {
-                appendMessage("msg-agent", {
-                    answer: msg.content,
-                    sources: msg.sources || "",
-                    thought: msg.thought || ""
-                }, true);
+                div = appendMessage("msg-agent", { answer: msg.content }, true);
+                if (msg.has_details) attachLazyDetails(div, data.id, msg.index);
             }
+            if (div && anchor) container.insertBefore(div, anchor);
         });
-        
-        toggleHistoryPanel(); 
+
+        // Quedan mensajes más antiguos: botón para cargarlos arriba
+        if (data.next_before !== null) {
+            const more = document.createElement('button');
+            more.id = 'messages-more';
+            more.innerText = "Cargar mensajes anteriores";
+            more.style.cssText = "width:100%; padding:6px; margin-bottom:6px; border:none; background:#f4f4f4; cursor:pointer; font-size:11px;";
+            more.onclick = () => loadConversation(id, data.next_before);
+            container.insertBefore(more, container.firstChild);
+        }
+
+        if (before === null) {
+            container.scrollTop = container.scrollHeight;
+            toggleHistoryPanel(); 
+        } else {
+            container.scrollTop = container.scrollHeight - previousHeight;
+        }
     } catch(e) { console.error(e); }
 }
 
+function attachLazyDetails(div, conversationId, index) {
+    const details = document.createElement("details");
+    details.style.cssText = "margin-top:12px; border-top:1px solid #eee; padding-top:5px;";
+    details.innerHTML = `<summary style="cursor:pointer; font-size:11px; color:#D35400;">Referencias y razonamiento</summary><div style="margin-top:5px; font-size:10px; color:#555;">Cargando...</div>`;
+    let loaded = false;
+    details.addEventListener("toggle", async () => {
+        if (!details.open || loaded) return;
+        loaded = true;
+        const body = details.querySelector("div");
+        try {
+            const res = await fetch(`${SERVER_URL}/conversations/${conversationId}/messages/${index}/details`);
+            const info = await res.json();
+            let html = "";
+            if (info.sources) {
+                html += `<div style="background:#FFF0E6; border-radius:4px; padding:5px;">${info.sources.replace(/\n/g, "<br>")}</div>`;
+            }
+            if (info.thought) {
+                html += `<div style="margin-top:6px; color:#666; font-family:monospace; white-space:pre-wrap;">${info.thought.replace(/</g, "&lt;")}</div>`;
+            }
+            body.innerHTML = html || "Sin detalles.";
+        } catch(e) {
+            loaded = false;
+            body.innerText = "No se pudieron cargar los detalles.";
+        }
+    });
+    const insertBtn = div.querySelector(".insert-btn");
+    if (insertBtn) div.insertBefore(details, insertBtn.previousSibling);
+    else div.appendChild(details);
+}
+
 async function deleteChat(e, id) {
     e.stopPropagation(); 
     if(!confirm("¿Borrar esta conversación?")) return;
@@ -419,8 +482,9 @@ async function sendMessage() {
     const hasContext = pill && pill.classList.contains("active");
     const contextToSend = hasContext ? lastSelection : "";
 
+    let streamDiv = null;
     try {
-        const response = await fetch(`${SERVER_URL}/titi`, {
+        const response = await fetch(`${SERVER_URL}/titi/stream`, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({ 
@@ -430,18 +494,76 @@ async function sendMessage() {
                 mode: currentMode // <--- AQUÍ ENVIAMOS EL NUEVO PARÁMETRO
             })
         });
-
-        const data = await response.json();
-        if (data.conversation_id) currentConversationId = data.conversation_id;
-        appendMessage("msg-agent", data, true);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+
+        // Respuesta NDJSON: un evento por línea (meta, query, sources, token, done, error)
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let answer = "";
+        let sources = "";
+        let thought = "";
+
+        const handleEvent = (event) => {
+            if (event.type === "meta" && event.conversation_id) {
+                currentConversationId = event.conversation_id;
+            } else if (event.type === "query") {
+                streamDiv = createStreamingMessage(`Buscando: "${event.query}"...`);
+            } else if (event.type === "sources") {
+                sources = event.sources || "";
+                thought = event.thought || "";
+            } else if (event.type === "token") {
+                if (!streamDiv) streamDiv = createStreamingMessage("");
+                answer += event.text;
+                updateStreamingMessage(streamDiv, answer);
+            } else if (event.type === "done") {
+                if (event.conversation_id) currentConversationId = event.conversation_id;
+                if (streamDiv) streamDiv.remove();
+                streamDiv = null;
+                appendMessage("msg-agent", { answer: event.answer, sources: sources, thought: thought }, true);
+            } else if (event.type === "error") {
+                throw new Error(event.message);
+            }
+        };
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let newline;
+            while ((newline = buffer.indexOf("\n")) >= 0) {
+                const line = buffer.slice(0, newline).trim();
+                buffer = buffer.slice(newline + 1);
+                if (line) handleEvent(JSON.parse(line));
+            }
+        }
+        if (buffer.trim()) handleEvent(JSON.parse(buffer));
 
     } catch (error) {
+        if (streamDiv) streamDiv.remove();
         appendMessage("msg-agent", ` Error: ${error.message}`);
     } finally {
         setLoading(false);
     }
 }
 
+function createStreamingMessage(initialText) {
+    const container = document.getElementById("chat-container");
+    const div = document.createElement("div");
+    div.className = "message msg-agent";
+    div.innerHTML = `<div style="font-size:13px; color:#2c3e50;"></div>`;
+    div.firstChild.innerText = initialText;
+    container.appendChild(div);
+    container.scrollTop = container.scrollHeight;
+    return div;
+}
+
+function updateStreamingMessage(div, text) {
+    const container = document.getElementById("chat-container");
+    div.firstChild.innerText = text;
+    container.scrollTop = container.scrollHeight;
+}
+
 
 function onSelectionChange(eventArgs) { checkSelectionContext(); }
 async function checkSelectionContext() {
@@ -492,6 +614,7 @@ function appendMessage(cls, content, showAction = false) {
     div.innerHTML = htmlContent;
     container.appendChild(div);
     container.scrollTop = container.scrollHeight;
+    return div;
 }
 function setLoading(isLoading) {
     const loader = document.getElementById("loader");
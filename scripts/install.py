@@ -39,7 +39,7 @@ torchvision
 torchaudio
 transformers
 sentence-transformers
-ctransformers[cuda]
+llama-cpp-python
 accelerate
 bitsandbytes
 pywin32
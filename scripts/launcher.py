@@ -9,6 +9,7 @@ from tkinter import ttk, messagebox
 import urllib.request
 import urllib.error
 import ssl
+import json
 
 try:
     SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__)) 
@@ -33,6 +34,13 @@ ctx.check_hostname = False
 ctx.verify_mode = ssl.CERT_NONE
 
 HEALTH_URL = "https://127.0.0.1:8010/health"
+# Etapas que reporta /health (503) mientras el modelo carga en segundo plano
+LOAD_STAGES = {
+    "pendiente": "INICIANDO MOTOR",
+    "cargando": "CARGANDO MODELO",
+    "calentando": "CALENTANDO MODELO",
+    "error": "ERROR CARGANDO MODELO",
+}
 process = None
 
 def check_server_ready():
@@ -43,15 +51,25 @@ def check_server_ready():
         set_ui_state("STOPPED")
         return
 
+    stage = "CARGANDO MODELO"
+    elapsed = int(time.time()) % 60
     try:
         with urllib.request.urlopen(HEALTH_URL, context=ctx, timeout=1) as response:
             if response.getcode() == 200:
                 set_ui_state("READY")
                 return
+    except urllib.error.HTTPError as e:
+        # El servidor ya responde: 503 con la etapa de carga del modelo
+        try:
+            info = json.loads(e.read().decode("utf-8"))
+            stage = LOAD_STAGES.get(info.get("stage"), stage)
+            elapsed = int(info.get("elapsed_s", elapsed))
+        except:
+            pass
     except:
         pass 
 
-    lbl_status.config(text=f"Estado: CARGANDO MODELO... ({int(time.time()) % 60}s)")
+    lbl_status.config(text=f"Estado: {stage}... ({elapsed}s)")
     root.after(1000, check_server_ready)
 
 def start_server():
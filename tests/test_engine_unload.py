@@ -0,0 +1,58 @@
+import gc
+
+import torch
+
+from engine import LLMEngine
+from tiny_model import build_model, build_tokenizer
+
+
+def _tensors_of(obj):
+    """
+    Tensores alcanzables desde `obj` (atributos, listas, dicts, KV-caches), sin contar parámetros
+    de módulos que ya no estén referenciados.
+    """
+    seen, found, stack = set(), [], [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, torch.Tensor):
+            found.append(item)
+        elif isinstance(item, torch.nn.Module):
+            found.extend(item.parameters())
+        elif isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__") and not isinstance(item, type):
+            stack.extend(vars(item).values())
+    return found
+
+
+def test_unload_drops_gpu_state_before_release():
+    tokenizer = build_tokenizer()
+    model = build_model(tokenizer)
+    draft = build_model(tokenizer, hidden_size=64, num_layers=1, seed=1)
+    engine = LLMEngine.from_components(tokenizer, model, use_scheduler=False, speculative="draft", draft_model=draft)
+    engine.register_prefix("<start_of_turn>user\nSistema ")
+    engine.generate("<start_of_turn>user\nSistema hola", max_tokens=4, session_id="c1")
+    assert engine.prefix_cache and len(engine.session_cache) == 1
+    del model, draft
+
+    # Lo que sigue referenciado cuando la política de memoria llama a empty_cache
+    alive = {}
+    release = engine.memory.release
+
+    def _spy():
+        alive["prefix"] = len(engine.prefix_cache)
+        alive["sessions"] = len(engine.session_cache)
+        alive["tensors"] = len(_tensors_of(engine))
+        release()
+    engine.memory.release = _spy
+
+    engine.unload_model()
+    gc.collect()
+    assert alive == {"prefix": 0, "sessions": 0, "tensors": 0}
+    assert engine.draft_model is None
+    assert not hasattr(engine, "model")
@@ -0,0 +1,76 @@
+import gc
+import os
+
+import numpy as np
+
+from memory_index import SemanticIndex
+from tiny_model import HashEmbedder
+
+
+def _mapped(path):
+    """
+    Memmaps vivos sobre `path` (lo que en Windows impide reemplazar el archivo).
+    """
+    path = os.path.abspath(path)
+    gc.collect()
+    return [obj for obj in gc.get_objects()
+            if isinstance(obj, np.memmap) and obj._mmap is not None and os.path.abspath(obj.filename) == path]
+
+
+def _windows_replace(monkeypatch):
+    real_replace = os.replace
+
+    def _replace(src, dst):
+        if _mapped(dst):
+            raise PermissionError(f"El archivo está mapeado: {dst}")
+        return real_replace(src, dst)
+    monkeypatch.setattr(os, "replace", _replace)
+
+
+def _index(path):
+    embedder = HashEmbedder(dim=384)
+    return SemanticIndex(lambda: embedder, index_dir=str(path))
+
+
+def test_compact_while_matrix_is_mapped(tmp_path, monkeypatch):
+    index = _index(tmp_path)
+    index.add([{"text": f"snippet {i} sobre tutela", "href": f"https://ejemplo.co/{i}", "mode": "legal"}
+               for i in range(8)])
+    index.add([{"text": "respuesta privada sobre salud", "kind": "answer", "mode": "legal",
+                "conversation_id": "c1"}])
+    # search() deja la matriz mapeada en el índice
+    assert index.search("respuesta privada sobre salud", k=1)[0][1]["conversation_id"] == "c1"
+    assert index._matrix is not None
+
+    _windows_replace(monkeypatch)
+    with index._lock:
+        index._bury([i for i, m in enumerate(index.meta) if m.get("conversation_id") == "c1"])
+    assert index.compact() == 1
+
+    assert len(index) == 8
+    assert os.path.getsize(tmp_path / "vectors.f32") == 8 * 384 * 4
+    assert "privada" not in (tmp_path / "meta.jsonl").read_text(encoding="utf-8")
+    assert all(m.get("conversation_id") != "c1" for _, m in index.search("respuesta privada sobre salud"))
+
+    # Lo que se agrega después queda alineado con su fila, también tras reabrir
+    index.add([{"text": "nuevo snippet sobre inmediatez", "href": "https://ejemplo.co/nuevo", "mode": "legal"}])
+    reopened = _index(tmp_path)
+    assert reopened.search("nuevo snippet sobre inmediatez", k=1)[0][1]["href"] == "https://ejemplo.co/nuevo"
+
+
+def test_startup_compaction_after_remove(tmp_path, monkeypatch):
+    index = _index(tmp_path)
+    index.add([{"text": "respuesta de la conversación borrada", "kind": "answer", "conversation_id": "c2"},
+               {"text": "snippet que se conserva", "href": "https://ejemplo.co/x"}])
+    index.search("snippet que se conserva")
+    # Solo la lápida: la compactación en segundo plano no alcanzó a correr
+    with open(index.tombstones_path, "a", encoding="utf-8") as f:
+        f.write(index.meta[0]["key"] + "\n")
+    # El proceso anterior ya no existe (ni su memmap)
+    del index
+
+    _windows_replace(monkeypatch)
+    reopened = _index(tmp_path)
+    assert len(reopened) == 1
+    assert not os.path.exists(reopened.tombstones_path)
+    assert reopened.meta[0]["href"] == "https://ejemplo.co/x"
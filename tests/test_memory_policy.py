@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import torch
+from transformers import DynamicCache
+
+import engine
+import memory_policy
+from memory_policy import MemoryPolicy
+from session_cache import SessionCache
+
+
+def _kv(tokens):
+    return DynamicCache.from_legacy_cache(((torch.zeros(1, 1, tokens, 8), torch.zeros(1, 1, tokens, 8)),))
+
+
+def _fake_gpu(monkeypatch, reserved, events):
+    monkeypatch.setattr(memory_policy.torch.cuda, "memory_reserved", lambda: reserved[0])
+    monkeypatch.setattr(memory_policy.torch.cuda, "empty_cache", lambda: events.append("empty_cache"))
+
+
+def test_pressure_evicts_sessions_before_empty_cache(monkeypatch):
+    sessions = SessionCache(budget_bytes=10 ** 9)
+    for i in range(4):
+        sessions.put(f"c{i}", list(range(16)), _kv(16))
+    sessions.get("c0")  # c0 pasa a ser la más reciente
+
+    events, reserved = [], [0]
+    _fake_gpu(monkeypatch, reserved, events)
+    policy = MemoryPolicy(idle_cleanup_s=0)
+    policy.cuda, policy.total_bytes = True, 1000
+
+    def _evict():
+        events.append("evict")
+        return sessions.evict()
+    policy.register_evictor(_evict)
+
+    reserved[0] = 500
+    policy.after_generation()
+    assert events == [] and len(sessions) == 4
+
+    reserved[0] = 900
+    policy.after_generation()
+    assert events == ["evict", "empty_cache"]
+    # Se desaloja la mitad menos reciente
+    assert sorted(sessions._entries) == ["c0", "c3"]
+    assert policy.counters["evicted_bytes"] > 0
+
+
+def test_session_budget_follows_device_memory(monkeypatch):
+    monkeypatch.setattr(engine.torch.cuda, "get_device_properties",
+                        lambda device: SimpleNamespace(total_memory=4 * 1024 ** 3))
+    gpu_engine = SimpleNamespace(model=SimpleNamespace(device=torch.device("cuda", 0)))
+    assert engine.LLMEngine._session_budget_bytes(gpu_engine) == int(4 * 1024 ** 3 * engine.SESSION_CACHE_GPU_FRACTION)
+
+    cpu_engine = SimpleNamespace(model=SimpleNamespace(device=torch.device("cpu")))
+    assert engine.LLMEngine._session_budget_bytes(cpu_engine) == engine.SESSION_CACHE_CPU_BUDGET_MB * 1024 * 1024
+
+
+def test_engine_registers_session_evictor():
+    from tiny_model import load_tiny_llm
+
+    llm = load_tiny_llm()
+    try:
+        assert llm.memory._evictors == [llm.session_cache.evict]
+    finally:
+        llm.unload_model()